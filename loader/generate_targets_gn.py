@@ -16,7 +16,6 @@
 
 import os
 import sys
-import shutil
 
 _SOURCE_ROOT = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -25,7 +24,7 @@ sys.path.insert(1, os.path.join(_SOURCE_ROOT, 'third_party'))
 from jinja2 import Template  # noqa: E402
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from scripts.util.file_utils import write_file  # noqa: E402
+from scripts.util.file_utils import write_file, write_file_if_changed  # noqa: E402, E501
 
 parts_list_gni_template = """
 parts_list = [
@@ -86,7 +85,8 @@ def gen_targets_gn(parts_targets, config_output_dir):
     parts_list_gni_file = os.path.join(config_output_dir, 'parts_list.gni')
     parts_list_content = '"{}",'.format('",\n  "'.join(parts_list))
     write_file(parts_list_gni_file,
-               parts_list_gni_template.format(parts_list_content))
+               parts_list_gni_template.format(parts_list_content),
+               check_changes=True)
 
     inner_kits_gni_file = os.path.join(config_output_dir,
                                        'inner_kits_list.gni')
@@ -95,7 +95,8 @@ def gen_targets_gn(parts_targets, config_output_dir):
     else:
         inner_kits_content = ''
     write_file(inner_kits_gni_file,
-               inner_kits_gni_template.format(inner_kits_content))
+               inner_kits_gni_template.format(inner_kits_content),
+               check_changes=True)
 
     system_list_gni_file = os.path.join(config_output_dir,
                                         'system_kits_list.gni')
@@ -104,7 +105,8 @@ def gen_targets_gn(parts_targets, config_output_dir):
     else:
         system_kits_content = ''
     write_file(system_list_gni_file,
-               system_kits_gni_template.format(system_kits_content))
+               system_kits_gni_template.format(system_kits_content),
+               check_changes=True)
 
     parts_test_gni_file = os.path.join(config_output_dir,
                                        'parts_test_list.gni')
@@ -113,10 +115,12 @@ def gen_targets_gn(parts_targets, config_output_dir):
     else:
         test_list_content = ''
     write_file(parts_test_gni_file,
-               parts_test_gni_template.format(test_list_content))
+               parts_test_gni_template.format(test_list_content),
+               check_changes=True)
 
     build_gn_file = os.path.join(config_output_dir, 'BUILD.gn')
-    shutil.copyfile(gn_file_template, build_gn_file)
+    with open(gn_file_template, 'rb') as template_f:
+        write_file_if_changed(build_gn_file, template_f.read())
 
 
 def gen_phony_targets(variant_phony_targets, config_output_dir):
@@ -138,7 +142,8 @@ def gen_phony_targets(variant_phony_targets, config_output_dir):
 
     phony_build_file = os.path.join(config_output_dir, 'phony_targets',
                                     'BUILD.gn')
-    write_file(phony_build_file, '\n'.join(phony_build_content))
+    write_file(phony_build_file, '\n'.join(phony_build_content),
+               check_changes=True)
 
 
 def gen_stub_targets(parts_kits_info, platform_stubs, config_output_dir):
@@ -196,8 +201,8 @@ def gen_stub_targets(parts_kits_info, platform_stubs, config_output_dir):
                 platform=platform,
                 combined_jar_deps=',\n'.join(stub_kit_targets),
                 sources_list_files=',\n'.join(dist_stub))
-            write_file(gn_file, gn_contents)
+            write_file(gn_file, gn_contents, check_changes=True)
         else:
             gni_contents.append('zframework_stub_exists = false')
 
-        write_file(gni_file, '\n'.join(gni_contents))
+        write_file(gni_file, '\n'.join(gni_contents), check_changes=True)
@@ -22,7 +22,8 @@ from loader import subsystem_info  # noqa: E402
 from loader import platforms_loader  # noqa: E402
 from loader import generate_targets_gn  # noqa: E402
 from loader import load_ohos_build  # noqa: E402
-from scripts.util.file_utils import read_json_file, write_json_file, write_file  # noqa: E402, E501
+from loader import parts_config_cache  # noqa: E402
+from scripts.util.file_utils import read_json_file, write_json_file, write_file, get_write_stats  # noqa: E402, E501
 
 
 def _load_component_dist(source_root_dir, target_os, target_cpu):
@@ -275,16 +276,17 @@ def generate_syscap_files(parts_config_info, target_platform_parts, pre_syscap_i
     if not os.path.exists(system_etc_path):
         os.mkdir(system_etc_path)
     syscap_info_json = os.path.join(system_etc_path, "SystemCapability.json")
-    write_json_file(syscap_info_json, syscap_info_dict)
+    write_json_file(syscap_info_json, syscap_info_dict, check_changes=True)
     target_syscap_with_part_name_list.sort(key = syscap_sort)
     syscap_info_with_part_name_file = os.path.join(system_etc_path, "syscap.json")
-    write_json_file(syscap_info_with_part_name_file, {'components': target_syscap_with_part_name_list})
+    write_json_file(syscap_info_with_part_name_file, {'components': target_syscap_with_part_name_list},
+                    check_changes=True)
     if not os.path.exists(os.path.join(system_etc_path, "param/")):
         os.mkdir(os.path.join(system_etc_path, "param/"))
     target_syscap_for_init_file = os.path.join(system_etc_path, "param/syscap.para")
-    f = open(target_syscap_for_init_file, "w")
-    f.writelines(target_syscap_for_init_list)
-    f.close()
+    write_file(target_syscap_for_init_file,
+               ''.join(target_syscap_for_init_list),
+               check_changes=True)
 
 def load(args):
     source_root_dir = args.source_root_dir
@@ -294,7 +296,8 @@ def load(args):
     # loading subsystem info, scan src dir and get subsystem ohos.build
     _subsystem_info = subsystem_info.get_subsystem_info(
         args.subsystem_config_file, args.example_subsystem_file,
-        source_root_dir, config_output_relpath, args.os_level)
+        source_root_dir, config_output_relpath, args.os_level,
+        args.scan_stats)
 
     target_arch = '{}_{}'.format(args.target_os, args.target_cpu)
     # loading platforms config
@@ -317,9 +320,16 @@ def load(args):
                 ', '.join(_all_platforms)))
 
     # loading ohos.build and gen part variant info
+    parts_cache_file = os.path.join(source_root_dir, config_output_relpath,
+                                    'parts_info', 'parts_config_cache.json')
+    parts_cache = parts_config_cache.PartsConfigCache(
+        parts_cache_file, variant_toolchains, target_arch,
+        config_output_relpath)
     parts_config_info = load_ohos_build.get_parts_info(
         source_root_dir, config_output_relpath, _subsystem_info,
-        variant_toolchains, target_arch, args.ignore_api_check, args.build_xts)
+        variant_toolchains, target_arch, args.ignore_api_check, args.build_xts,
+        args.jobs, parts_cache)
+    parts_cache.save()
     # check parts_config_info
     _check_parts_config_info(parts_config_info)
     parts_variants = parts_config_info.get('parts_variants')
@@ -389,12 +399,14 @@ def load(args):
     # required_parts_targets.json
     build_targets_info_file = os.path.join(config_output_dir,
                                            "required_parts_targets.json")
-    write_json_file(build_targets_info_file, required_parts_targets)
+    write_json_file(build_targets_info_file, required_parts_targets,
+                    check_changes=True)
     # required_parts_targets_list.json
     build_targets_list_file = os.path.join(config_output_dir,
                                            "required_parts_targets_list.json")
     write_json_file(build_targets_list_file,
-                    list(required_parts_targets.values()))
+                    list(required_parts_targets.values()),
+                    check_changes=True)
 
     # parts src flag file
     parts_src_flag_file = os.path.join(config_output_dir,
@@ -416,7 +428,8 @@ def load(args):
     if 'phone' not in build_platforms:
         _gni_file_content.append('  "phone"')
     _gni_file_content.append(']')
-    write_file(platforms_list_gni_file, '\n'.join(_gni_file_content))
+    write_file(platforms_list_gni_file, '\n'.join(_gni_file_content),
+               check_changes=True)
 
     # parts_different_info.json
     # Generate parts differences in different platforms, using phone as base.
@@ -439,6 +452,13 @@ def load(args):
     system_path = os.path.join(source_root_dir, os.path.join(os.path.dirname(args.platforms_config_file), "system/"))
     generate_syscap_files(parts_config_info, target_platform_parts, pre_syscap_info_path, system_path)
 
+    _cache_stats = parts_cache.stats()
+    print("parts config cache: {} hits, {} misses".format(
+        _cache_stats.get('hits'), _cache_stats.get('misses')))
+    _write_stats = get_write_stats()
+    print("build configs: {} files written, {} unchanged".format(
+        _write_stats.get('written'), _write_stats.get('unchanged')))
+
 def _output_infos_by_platform(part_name_infos, parts_info_dict):
     required_parts = {}
     subsystem_infos = {}
@@ -494,6 +514,10 @@ def main():
 
     parser.add_argument('--scalable-build', action='store_true')
     parser.set_defaults(scalable_build=False)
+    parser.add_argument('--scan-stats', action='store_true')
+    parser.set_defaults(scan_stats=False)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of subsystems parsed in parallel.')
     args = parser.parse_args()
 
     load(args)
@@ -15,6 +15,7 @@
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import load_bundle_file
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -295,11 +296,27 @@ class PartObject(object):
         """part kits."""
         return self._kits
 
+    def build_gn_file(self, config_output_dir):
+        """build gn file path."""
+        return os.path.join(config_output_dir, self._part_name, 'BUILD.gn')
+
     def write_build_gn(self, config_output_dir):
         """output build gn."""
-        part_gn_file = os.path.join(config_output_dir, self._part_name,
-                                    'BUILD.gn')
-        write_file(part_gn_file, '\n'.join(self._build_gn_content))
+        part_gn_file = self.build_gn_file(config_output_dir)
+        write_file(part_gn_file, '\n'.join(self._build_gn_content),
+                   check_changes=True)
+        return part_gn_file
+
+    def to_cache(self):
+        """parsed part state, json serializable."""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_cache(cls, part_state):
+        """restore a part object without parsing config again."""
+        part_obj = cls.__new__(cls)
+        part_obj.__dict__.update(part_state)
+        return part_obj
 
     def get_target_label(self, config_output_relpath):
         """target label."""
@@ -359,7 +376,7 @@ class LoadBuildConfig(object):
 
     def __init__(self, source_root_dir, subsystem_build_info,
                  config_output_dir, variant_toolchains, subsystem_name,
-                 target_arch, ignored_subsystems):
+                 target_arch, ignored_subsystems, parts_cache=None):
         self._source_root_dir = source_root_dir
         self._build_info = subsystem_build_info
         self._config_output_relpath = config_output_dir
@@ -376,6 +393,78 @@ class LoadBuildConfig(object):
         self._parts_path_dict = {}
         self._part_hisysevent_config = {}
         self._parts_module_list = {}
+        self._parts_cache = parts_cache
+        self._build_file_configs = {}
+        self._build_file_cache = {}
+        self._part_build_files = {}
+        self._cache_records = {}
+
+    def _read_build_config(self, build_file):
+        cache_entry = None
+        if self._parts_cache is not None:
+            cache_entry = self._parts_cache.get(build_file,
+                                                self._subsystem_name)
+        if cache_entry is not None:
+            _parts_config = cache_entry.get('build_config')
+        elif build_file.endswith('bundle.json'):
+            bundle_part_obj = load_bundle_file.BundlePartObj(build_file)
+            _parts_config = bundle_part_obj.to_ohos_build()
+        else:
+            _parts_config = read_build_file(build_file)
+        self._build_file_cache[build_file] = cache_entry
+        self._build_file_configs[build_file] = _parts_config
+        self._cache_records[build_file] = {
+            'build_config': _parts_config,
+            'parts': {}
+        }
+        return _parts_config
+
+    def _get_part_object(self, part_name, variant, part_config, toolchain):
+        _build_file = self._part_build_files.get(part_name)
+        cache_entry = self._build_file_cache.get(_build_file)
+        if cache_entry is not None:
+            part_cache = cache_entry.get('parts').get(part_name, {})
+            cached_part = part_cache.get(variant)
+            if cached_part is not None:
+                return PartObject.from_cache(
+                    cached_part.get('part_object')), cached_part
+        part_obj = PartObject(part_name, variant, part_config, toolchain,
+                              self._subsystem_name, self._target_arch)
+        return part_obj, None
+
+    @staticmethod
+    def _write_build_gn(part_obj, build_gn_dir, cached_part):
+        # unchanged parts whose BUILD.gn is untouched skip the write and
+        # the gn format call.
+        if cached_part is not None:
+            try:
+                _mtime = os.stat(
+                    part_obj.build_gn_file(build_gn_dir)).st_mtime_ns
+            except OSError:
+                _mtime = None
+            if _mtime is not None and _mtime == cached_part.get(
+                    'build_gn_mtime'):
+                return _mtime
+        part_gn_file = part_obj.write_build_gn(build_gn_dir)
+        return os.stat(part_gn_file).st_mtime_ns
+
+    def _record_part_object(self, part_name, variant, part_obj,
+                            build_gn_mtime):
+        _build_file = self._part_build_files.get(part_name)
+        _record = self._cache_records.get(_build_file)
+        if _record is None:
+            return
+        part_record = _record.get('parts').setdefault(part_name, {})
+        part_record[variant] = {
+            'part_object': part_obj.to_cache(),
+            'build_gn_mtime': build_gn_mtime
+        }
+
+    def _save_cache_records(self):
+        if self._parts_cache is None:
+            return
+        for _build_file, _record in self._cache_records.items():
+            self._parts_cache.put(_build_file, self._subsystem_name, _record)
 
     def _parsing_config(self, parts_config):
         _parts_info_dict = {}
@@ -394,15 +483,19 @@ class LoadBuildConfig(object):
                 toolchain = self._variant_toolchains.get(variant)
                 if toolchain is None:
                     continue
-                part_obj = PartObject(part_name, variant, value, toolchain,
-                                      self._subsystem_name, self._target_arch)
+                part_obj, cached_part = self._get_part_object(
+                    part_name, variant, value, toolchain)
                 real_part_name = part_obj.part_name()
                 self._part_list[real_part_name] = part_obj
 
                 subsystem_config_dir = os.path.join(
                     self._config_output_relpath, self._subsystem_name)
-                part_obj.write_build_gn(
-                    os.path.join(self._source_root_dir, subsystem_config_dir))
+                build_gn_mtime = self._write_build_gn(
+                    part_obj,
+                    os.path.join(self._source_root_dir, subsystem_config_dir),
+                    cached_part)
+                self._record_part_object(part_name, variant, part_obj,
+                                         build_gn_mtime)
 
                 _target_label = part_obj.get_target_label(subsystem_config_dir)
                 _build_target[variant] = _target_label
@@ -434,11 +527,7 @@ class LoadBuildConfig(object):
         parts_info = {}
         parts_path_dict = {}
         for _build_file in _build_files:
-            if _build_file.endswith('bundle.json'):
-                bundle_part_obj = load_bundle_file.BundlePartObj(_build_file)
-                _parts_config = bundle_part_obj.to_ohos_build()
-            else:
-                _parts_config = read_build_file(_build_file)
+            _parts_config = self._read_build_config(_build_file)
             _subsystem_name = _parts_config.get('subsystem')
             if not is_thirdparty_subsystem and subsystem_name and _subsystem_name != subsystem_name:
                 raise Exception(
@@ -449,6 +538,7 @@ class LoadBuildConfig(object):
             for _pname in _curr_parts_info.keys():
                 parts_path_dict[_pname] = os.path.relpath(
                     os.path.dirname(_build_file), self._source_root_dir)
+                self._part_build_files[_pname] = _build_file
             parts_info.update(_curr_parts_info)
         subsystem_config = {}
         subsystem_config['subsystem'] = subsystem_name
@@ -456,12 +546,18 @@ class LoadBuildConfig(object):
         return subsystem_config, parts_path_dict
 
     def parse_syscap_info(self):
+        self.parse()
         _build_files = self._build_info.get('build_files')
         subsystem_syscap = []
         for _build_file in _build_files:
             if _build_file.endswith('bundle.json'):
-                part_name, part_syscap = get_syscap_from_bundle(_build_file)
-                subsystem_syscap.append({'component': part_name, 'syscap': part_syscap})
+                # reuse the parsed bundle, same as get_syscap_from_bundle
+                _parts_config = self._build_file_configs.get(_build_file)
+                for part_name, _info in _parts_config.get('parts').items():
+                    part_syscap = _info.get('system_capabilities')
+                    if part_syscap is not None:
+                        part_syscap = list(part_syscap)
+                    subsystem_syscap.append({'component': part_name, 'syscap': part_syscap})
         return subsystem_syscap
 
     def parse(self):
@@ -473,8 +569,13 @@ class LoadBuildConfig(object):
         self._parts_module_list.update(parts_config)
         self._parsing_config(parts_config)
         self._parts_path_dict = parts_path_dict
+        self._save_cache_records()
         self._is_load = True
 
+    def subsystem_name(self):
+        """subsystem name."""
+        return self._subsystem_name
+
     def parts_variants(self):
         """parts varinats info."""
         self.parse()
@@ -538,7 +639,7 @@ def _output_parts_info(parts_config_dict, config_output_path):
         parts_info = parts_config_dict.get('parts_info')
         parts_info_file = os.path.join(parts_info_output_path,
                                        "parts_info.json")
-        write_json_file(parts_info_file, parts_info)
+        write_json_file(parts_info_file, parts_info, check_changes=True)
         _part_subsystem_dict = {}
         for key, value in parts_info.items():
             for _info in value:
@@ -547,14 +648,16 @@ def _output_parts_info(parts_config_dict, config_output_path):
                 break
         _part_subsystem_file = os.path.join(parts_info_output_path,
                                             "part_subsystem.json")
-        write_json_file(_part_subsystem_file, _part_subsystem_dict)
+        write_json_file(_part_subsystem_file, _part_subsystem_dict,
+                        check_changes=True)
 
     # subsystem_parts.json
     if 'subsystem_parts' in parts_config_dict:
         subsystem_parts = parts_config_dict.get('subsystem_parts')
         subsystem_parts_file = os.path.join(parts_info_output_path,
                                             "subsystem_parts.json")
-        write_json_file(subsystem_parts_file, subsystem_parts)
+        write_json_file(subsystem_parts_file, subsystem_parts,
+                        check_changes=True)
         # adapter mini system
         for _sub_name, _p_list in subsystem_parts.items():
             _output_info = {}
@@ -562,42 +665,48 @@ def _output_parts_info(parts_config_dict, config_output_path):
             _sub_info_output_file = os.path.join(config_output_path,
                                                  'mini_adapter',
                                                  '{}.json'.format(_sub_name))
-            write_json_file(_sub_info_output_file, _output_info)
+            write_json_file(_sub_info_output_file, _output_info,
+                            check_changes=True)
 
     # parts_variants.json
     if 'parts_variants' in parts_config_dict:
         parts_variants = parts_config_dict.get('parts_variants')
         parts_variants_info_file = os.path.join(parts_info_output_path,
                                                 "parts_variants.json")
-        write_json_file(parts_variants_info_file, parts_variants)
+        write_json_file(parts_variants_info_file, parts_variants,
+                        check_changes=True)
 
     # inner_kits_info.json
     if 'parts_inner_kits_info' in parts_config_dict:
         parts_inner_kits_info = parts_config_dict.get('parts_inner_kits_info')
         parts_inner_kits_info_file = os.path.join(parts_info_output_path,
                                                   "inner_kits_info.json")
-        write_json_file(parts_inner_kits_info_file, parts_inner_kits_info)
+        write_json_file(parts_inner_kits_info_file, parts_inner_kits_info,
+                        check_changes=True)
 
     # parts_targets.json
     if 'parts_targets' in parts_config_dict:
         parts_targets = parts_config_dict.get('parts_targets')
         parts_targets_info_file = os.path.join(parts_info_output_path,
                                                "parts_targets.json")
-        write_json_file(parts_targets_info_file, parts_targets)
+        write_json_file(parts_targets_info_file, parts_targets,
+                        check_changes=True)
 
     # phony_targets.json
     if 'phony_target' in parts_config_dict:
         phony_target = parts_config_dict.get('phony_target')
         phony_target_info_file = os.path.join(parts_info_output_path,
                                               "phony_target.json")
-        write_json_file(phony_target_info_file, phony_target)
+        write_json_file(phony_target_info_file, phony_target,
+                        check_changes=True)
 
     # paths_path_info.json
     if 'parts_path_info' in parts_config_dict:
         parts_path_info = parts_config_dict.get('parts_path_info')
         parts_path_info_file = os.path.join(parts_info_output_path,
                                             'parts_path_info.json')
-        write_json_file(parts_path_info_file, parts_path_info)
+        write_json_file(parts_path_info_file, parts_path_info,
+                        check_changes=True)
         path_to_parts = {}
         for _key, _val in parts_path_info.items():
             _p_list = path_to_parts.get(_val, [])
@@ -605,14 +714,15 @@ def _output_parts_info(parts_config_dict, config_output_path):
             path_to_parts[_val] = _p_list
         path_to_parts_file = os.path.join(parts_info_output_path,
                                           'path_to_parts.json')
-        write_json_file(path_to_parts_file, path_to_parts)
+        write_json_file(path_to_parts_file, path_to_parts, check_changes=True)
 
     # hisysevent_config
     if 'hisysevent_config' in parts_config_dict:
         hisysevent_config = parts_config_dict.get('hisysevent_config')
         hisysevent_info_file = os.path.join(parts_info_output_path,
                                             'hisysevent_configs.json')
-        write_json_file(hisysevent_info_file, hisysevent_config)
+        write_json_file(hisysevent_info_file, hisysevent_config,
+                        check_changes=True)
 
     # _parts_modules_info
     if 'parts_modules_info' in parts_config_dict:
@@ -628,7 +738,22 @@ def _output_parts_info(parts_config_dict, config_output_path):
         _output_info['parts'] = _all_p_info
         parts_modules_info_file = os.path.join(parts_info_output_path,
                                                'parts_modules_info.json')
-        write_json_file(parts_modules_info_file, _output_info)
+        write_json_file(parts_modules_info_file, _output_info,
+                        check_changes=True)
+
+
+def _parse_build_config(build_loader):
+    build_loader.parse()
+    return build_loader, build_loader.parse_syscap_info()
+
+
+def _load_build_configs(build_loaders, jobs):
+    if jobs <= 1 or len(build_loaders) <= 1:
+        return [_parse_build_config(_loader) for _loader in build_loaders]
+    # Parsing is dominated by file reads and 'gn format' subprocesses, so
+    # threads are enough. map() keeps the subsystem order for merging.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_parse_build_config, build_loaders))
 
 
 def get_parts_info(source_root_dir,
@@ -637,7 +762,9 @@ def get_parts_info(source_root_dir,
                    variant_toolchains,
                    target_arch,
                    ignored_subsystems,
-                   build_xts=False):
+                   build_xts=False,
+                   jobs=1,
+                   parts_cache=None):
     """parts info,
     get info from build config file.
     """
@@ -652,13 +779,18 @@ def get_parts_info(source_root_dir,
     _parts_hisysevent_config = {}
     _parts_modules_info = {}
     system_syscap = []
+    build_loaders = []
     for subsystem_name, build_config_info in subsystem_info.items():
         if subsystem_name == 'xts' and build_xts is False:
             continue
         build_loader = LoadBuildConfig(source_root_dir, build_config_info,
                                        config_output_relpath,
                                        variant_toolchains, subsystem_name,
-                                       target_arch, ignored_subsystems)
+                                       target_arch, ignored_subsystems,
+                                       parts_cache)
+        build_loaders.append(build_loader)
+    for build_loader, _syscap in _load_build_configs(build_loaders, jobs):
+        subsystem_name = build_loader.subsystem_name()
         _parts_variants = build_loader.parts_variants()
         parts_variants.update(_parts_variants)
         _inner_kits_info = build_loader.parts_inner_kits_info()
@@ -672,7 +804,7 @@ def get_parts_info(source_root_dir,
         _parts_path_info.update(build_loader.parts_path_info())
         _parts_hisysevent_config.update(build_loader.parts_hisysevent_config())
         _parts_modules_info.update(build_loader.parts_modules_info())
-        system_syscap.extend(build_loader.parse_syscap_info())
+        system_syscap.extend(_syscap)
     parts_config_dict = {}
     parts_config_dict['parts_info'] = parts_info
     parts_config_dict['subsystem_parts'] = subsystem_parts
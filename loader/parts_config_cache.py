@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import threading
+
+_parts_config_cache_version = 1
+
+
+class PartsConfigCache(object):
+    """parsed ohos.build/bundle.json cache, keyed by file content."""
+
+    def __init__(self, cache_file, variant_toolchains, target_arch,
+                 config_output_relpath):
+        self._cache_file = cache_file
+        self._config_key = json.dumps([
+            _parts_config_cache_version, variant_toolchains, target_arch,
+            config_output_relpath
+        ], sort_keys=True)
+        self._entries = {}
+        self._new_entries = {}
+        self._entry_keys = {}
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, 'r') as input_f:
+                data = json.load(input_f)
+        except (OSError, ValueError):
+            # a broken cache only costs a full parse
+            return
+        if data.get('version') != _parts_config_cache_version:
+            return
+        self._entries = data.get('entries', {})
+
+    def _entry_key(self, build_file, subsystem_name):
+        with open(build_file, 'rb') as input_f:
+            content_hash = hashlib.sha256(input_f.read()).hexdigest()
+        key_str = '\n'.join(
+            [self._config_key, build_file, subsystem_name, content_hash])
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def get(self, build_file, subsystem_name):
+        """cached entry of build_file, None if the file changed."""
+        try:
+            key = self._entry_key(build_file, subsystem_name)
+        except OSError:
+            # let the parser report the missing file
+            return None
+        with self._lock:
+            self._entry_keys[(build_file, subsystem_name)] = key
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return entry
+
+    def put(self, build_file, subsystem_name, entry):
+        with self._lock:
+            key = self._entry_keys.get((build_file, subsystem_name))
+            if key is not None:
+                self._new_entries[key] = entry
+
+    def save(self):
+        """write entries used in this run, stale ones are dropped."""
+        if not self._cache_file:
+            return
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '{}.tmp'.format(self._cache_file)
+        with open(tmp_file, 'w') as output_f:
+            json.dump(
+                {
+                    'version': _parts_config_cache_version,
+                    'entries': self._new_entries
+                },
+                output_f,
+                separators=(',', ':'))
+        os.replace(tmp_file, self._cache_file)
+
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses}
@@ -25,7 +25,7 @@ def _output_subsystem_configs(output_dir, subsystem_configs):
     build_config_file_name = "subsystem_build_config.json"
     build_config_file = os.path.join(output_dir, 'subsystem_info',
                                      build_config_file_name)
-    write_json_file(build_config_file, subsystem_configs)
+    write_json_file(build_config_file, subsystem_configs, check_changes=True)
 
     src_output_file_name = "src_subsystem_info.json"
     no_src_output_file_name = "no_src_subsystem_info.json"
@@ -35,24 +35,32 @@ def _output_subsystem_configs(output_dir, subsystem_configs):
         src_subsystem[key] = val.get('path')
     src_output_file = os.path.join(output_dir, 'subsystem_info',
                                    src_output_file_name)
-    write_json_file(src_output_file, src_subsystem)
+    write_json_file(src_output_file, src_subsystem, check_changes=True)
 
     no_src_output_file = os.path.join(output_dir, 'subsystem_info',
                                       no_src_output_file_name)
     write_json_file(no_src_output_file,
-                    subsystem_configs.get('no_src_subsystem'))
+                    subsystem_configs.get('no_src_subsystem'),
+                    check_changes=True)
 
 
-def get_subsystem_info(subsystem_config_file, example_subsystem_file,
-                       source_root_dir, config_output_path, os_level):
+def get_subsystem_info(subsystem_config_file,
+                       example_subsystem_file,
+                       source_root_dir,
+                       config_output_path,
+                       os_level,
+                       scan_stats=False):
     if not subsystem_config_file:
         subsystem_config_file = 'build/subsystem_config.json'
 
     subsystem_configs = {}
     output_dir_realpath = os.path.join(source_root_dir, config_output_path)
+    scan_cache_file = os.path.join(output_dir_realpath, 'subsystem_info',
+                                   'subsystem_scan_cache.json')
     subsystem_configs = subsystem_scan.scan(subsystem_config_file,
                                             example_subsystem_file,
-                                            source_root_dir)
+                                            source_root_dir, scan_cache_file,
+                                            scan_stats)
 
     _output_subsystem_configs(output_dir_realpath, subsystem_configs)
     return subsystem_configs.get('subsystem')
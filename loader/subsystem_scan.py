@@ -16,13 +16,21 @@
 import os
 import sys
 import argparse
-import glob
+import json
+import stat
+import time
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from scripts.util.file_utils import read_json_file, write_json_file  # noqa: E402 E501
 
 _default_subsystem = {"common": "build/common"}
 
+_build_file_names = ("ohos.build", "bundle.json")
+_scan_cache_version = 1
+# Directories modified this close to the scan start are not cached, their
+# mtime may still change within the same timestamp granularity.
+_racy_window_ns = 2 * 1000 * 1000 * 1000
+
 
 def _read_config(subsystem_config_file, example_subsystem_file):
     if not os.path.exists(subsystem_config_file):
@@ -46,20 +54,124 @@ def _read_config(subsystem_config_file, example_subsystem_file):
     return subsystem_info
 
 
-def _scan_build_file(subsystem_path):
-    build_config_file_name = "ohos.build"
-    search_str = "{}/**/{}".format(subsystem_path, build_config_file_name)
-    _files = glob.glob(search_str, recursive=True)
-    bundle_file_name = 'bundle.json'
-    _bundle_files = glob.glob("{}/**/{}".format(subsystem_path,
-                                                bundle_file_name),
-                              recursive=True)
-    if _bundle_files:
-        _files.extend(_bundle_files)
-    return _files
-
-
-def scan(subsystem_config_file, example_subsystem_file, source_root_dir):
+class ScanIndex(object):
+    """directory index, reuse listings of directories whose mtime unchanged."""
+
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        self._cached_dirs = {}
+        self._dirs = {}
+        self._visited = 0
+        self._skipped = 0
+        self._scan_start_ns = time.time_ns()
+        self._load()
+
+    def _load(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, 'r') as input_f:
+                data = json.load(input_f)
+        except (OSError, ValueError):
+            # a broken cache only costs a full scan
+            return
+        if data.get('version') != _scan_cache_version:
+            return
+        self._cached_dirs = data.get('dirs', {})
+
+    def save(self):
+        if not self._cache_file:
+            return
+        limit = self._scan_start_ns - _racy_window_ns
+        dirs = {}
+        for dir_path, entry in self._dirs.items():
+            if entry[0] < limit:
+                dirs[dir_path] = entry
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '{}.tmp'.format(self._cache_file)
+        with open(tmp_file, 'w') as output_f:
+            json.dump({'version': _scan_cache_version, 'dirs': dirs},
+                      output_f, separators=(',', ':'))
+        os.replace(tmp_file, self._cache_file)
+
+    def _list_dir(self, dir_path, dir_stat):
+        entry = self._dirs.get(dir_path)
+        if entry is not None:
+            return entry
+        entry = self._cached_dirs.get(dir_path)
+        if entry is not None and entry[0] == dir_stat.st_mtime_ns \
+                and entry[1] == dir_stat.st_ino:
+            self._skipped += 1
+        else:
+            self._visited += 1
+            subdirs = []
+            files = []
+            try:
+                with os.scandir(dir_path) as dir_entries:
+                    for dir_entry in dir_entries:
+                        # keep glob semantics, hidden entries are ignored
+                        if dir_entry.name.startswith('.'):
+                            continue
+                        if dir_entry.is_dir():
+                            subdirs.append(dir_entry.name)
+                        elif dir_entry.name in _build_file_names:
+                            files.append(dir_entry.name)
+            except OSError:
+                pass
+            entry = [dir_stat.st_mtime_ns, dir_stat.st_ino,
+                     sorted(subdirs), sorted(files)]
+        self._dirs[dir_path] = entry
+        return entry
+
+    def find_build_files(self, top_dir):
+        """ohos.build and bundle.json files under top_dir."""
+        found = {}
+        for name in _build_file_names:
+            found[name] = []
+        dir_stack = [(top_dir, ())]
+        while dir_stack:
+            dir_path, parent_keys = dir_stack.pop()
+            try:
+                dir_stat = os.stat(dir_path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(dir_stat.st_mode):
+                continue
+            # symlinked directories are followed like glob does, skip loops
+            dir_key = (dir_stat.st_dev, dir_stat.st_ino)
+            if dir_key in parent_keys:
+                continue
+            dir_keys = parent_keys + (dir_key, )
+            _, _, subdirs, files = self._list_dir(dir_path, dir_stat)
+            for name in files:
+                found[name].append(os.path.join(dir_path, name))
+            for subdir in reversed(subdirs):
+                dir_stack.append((os.path.join(dir_path, subdir), dir_keys))
+        _files = []
+        for name in _build_file_names:
+            _files.extend(sorted(found[name]))
+        return _files
+
+    def stats(self):
+        return {'visited': self._visited, 'skipped': self._skipped}
+
+
+def _scan_build_file(subsystem_path, scan_index):
+    return scan_index.find_build_files(subsystem_path)
+
+
+def _print_scan_stats(scan_stats):
+    _total = scan_stats.get('visited') + scan_stats.get('skipped')
+    print("subsystem scan: {} dirs, {} visited, {} skipped (unchanged)".format(
+        _total, scan_stats.get('visited'), scan_stats.get('skipped')))
+
+
+def scan(subsystem_config_file,
+         example_subsystem_file,
+         source_root_dir,
+         cache_file=None,
+         scan_stats=False):
     subsystem_infos = _read_config(subsystem_config_file,
                                    example_subsystem_file)
     # add common subsystem info
@@ -67,17 +179,22 @@ def scan(subsystem_config_file, example_subsystem_file, source_root_dir):
 
     no_src_subsystem = {}
     _build_configs = {}
+    scan_index = ScanIndex(cache_file)
     for key, val in subsystem_infos.items():
         _info = {'path': val}
         _subsystem_path = os.path.join(source_root_dir, val)
 
-        _build_config_files = _scan_build_file(_subsystem_path)
+        _build_config_files = _scan_build_file(_subsystem_path,
+                                              scan_index)
 
         if _build_config_files:
             _info['build_files'] = _build_config_files
             _build_configs[key] = _info
         else:
             no_src_subsystem[key] = val
+    scan_index.save()
+    if scan_stats:
+        _print_scan_stats(scan_index.stats())
 
     scan_result = {
         'source_path': source_root_dir,
@@ -93,14 +210,18 @@ def main():
     parser.add_argument('--example-subsystem-file', required=False)
     parser.add_argument('--source-root-dir', required=True)
     parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--scan-cache-file', required=False)
+    parser.add_argument('--scan-stats', action='store_true')
+    parser.set_defaults(scan_stats=False)
     args = parser.parse_args()
 
     build_configs = scan(args.subsystem_config_file,
-                         args.example_subsystem_file, args.source_root_dir)
+                         args.example_subsystem_file, args.source_root_dir,
+                         args.scan_cache_file, args.scan_stats)
 
     build_configs_file = os.path.join(args.output_dir,
                                       "subsystem_build_config.json")
-    write_json_file(build_configs_file, build_configs)
+    write_json_file(build_configs_file, build_configs, check_changes=True)
     return 0
 
 
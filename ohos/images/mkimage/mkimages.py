@@ -28,17 +28,50 @@ def run_cmd(cmd):
     return res.pid, res.returncode, sout, serr
 
 
-def build_rootdir(src_dir):
-    tmp_dir = tempfile.mkdtemp(prefix="tmp")
+def _stage_tree(src_dir, dest_dir, link, stats):
+    # Recreate src_dir at dest_dir like copytree(symlinks=True) does, but
+    # hardlink the files when |link| is set and the filesystem allows it.
+    os.makedirs(dest_dir, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        dest = os.path.join(dest_dir, entry.name)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), dest)
+        elif entry.is_dir():
+            _stage_tree(entry.path, dest, link, stats)
+        else:
+            size = entry.stat().st_size
+            if link:
+                try:
+                    os.link(entry.path, dest)
+                    stats['linked'] += size
+                    continue
+                except OSError:
+                    # e.g. another filesystem, copy it instead
+                    pass
+            shutil.copy2(entry.path, dest)
+            stats['copied'] += size
+    shutil.copystat(src_dir, dest_dir)
+
+
+def build_rootdir(src_dir, link=True):
+    """Stages root with src_dir as its system dir, returns the staging dir.
+
+    With |link|, files are hardlinked rather than copied. The staging dir is
+    created next to src_dir so that the links stay on one filesystem.
+    """
+    src_dir = os.path.abspath(src_dir)
+    tmp_dir = tempfile.mkdtemp(prefix="tmp", dir=os.path.dirname(src_dir))
     index = src_dir.rfind('/')
     root_dir = "%sroot" % src_dir[:index + 1]
 
+    stats = {'linked': 0, 'copied': 0}
     if root_dir:
-        shutil.rmtree(tmp_dir)
-        shutil.copytree(root_dir, tmp_dir, symlinks=True)
+        _stage_tree(root_dir, tmp_dir, link, stats)
     tmp_dir_system = os.path.join(tmp_dir, "system")
     shutil.rmtree(tmp_dir_system, ignore_errors=True)
-    shutil.copytree(src_dir, tmp_dir_system, symlinks=True)
+    _stage_tree(src_dir, tmp_dir_system, link, stats)
+    print("staged image root: %d bytes linked, %d bytes copied" %
+          (stats['linked'], stats['copied']))
     return tmp_dir
 
 
@@ -76,9 +109,20 @@ def mk_images(args):
     device = args[2]
     is_sparse = args[3]
 
+    mkfs_tools, mk_configs, fs_type = load_config(config_file)
+    staging_dir = None
     if "system.img" in device:
-        src_dir = build_rootdir(src_dir)
-    mkfs_tools, mk_configs, _ = load_config(config_file)
+        # cpio records link counts, give it plain copies
+        staging_dir = build_rootdir(src_dir, link=fs_type != "cpio")
+        src_dir = staging_dir
+    try:
+        _run_mkfs(src_dir, device, is_sparse, mkfs_tools, mk_configs)
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _run_mkfs(src_dir, device, is_sparse, mkfs_tools, mk_configs):
     if "ramdisk.img" == device:
         mk_configs = \
             " ".join([src_dir, device, "%s/../ramdisk_resource_config.ini" % src_dir])
@@ -24,7 +24,6 @@ Generate the project notice files, including both text and xml files.
 """
 from collections import defaultdict
 import argparse
-import hashlib
 import os
 import os.path
 import sys
@@ -37,6 +36,7 @@ sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(
         os.path.abspath(__file__)))))
 from scripts.util import build_utils  # noqa: E402
+from scripts.util import hash_utils  # noqa: E402
 from scripts.util.file_utils import write_json_file  # noqa: E402
 
 XML_ESCAPE_TABLE = {
@@ -87,11 +87,7 @@ def write_file(file, string):
 
 
 def compute_hash(file):
-    sha256 = hashlib.sha256()
-    with open(file, 'rb') as file_fd:
-        for line in file_fd:
-            sha256.update(line)
-    return sha256.hexdigest()
+    return hash_utils.file_digest(file, 'sha256')
 
 
 def get_entity(text):
@@ -15,14 +15,21 @@
 
 import sys
 import argparse
+import collections
+import concurrent.futures
+import json
 import os
 import shutil
+import stat
 
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(
         os.path.abspath(__file__)))))
 from scripts.util.file_utils import read_json_file, write_json_file, write_file  # noqa: E402
 from scripts.util import build_utils  # noqa: E402
+from scripts.util import file_utils  # noqa: E402
+from scripts.util import hash_utils  # noqa: E402
+from scripts.util import installed_files  # noqa: E402
 
 
 def _get_modules_info(system_install_info, depfiles):
@@ -60,38 +67,23 @@ def _get_post_process_modules_info(post_process_modules_info_files, depfiles):
     return modules_info_list
 
 
-def copy_modules(system_install_info, install_modules_info_file,
-                 modules_info_file, module_list_file,
-                 post_process_modules_info_files, platform_installed_path,
-                 additional_system_files, depfiles):
-    output_result = []
-    dest_list = []
-    symlink_dest = []
+_INSTALL_MANIFEST_VERSION = 1
 
-    modules_info_dict = _get_modules_info(system_install_info, depfiles)
-    for value in modules_info_dict.values():
-        module_info = read_json_file(value)
-        if not module_info:
-            raise Exception(
-                "read module install info file '{}' error.".format(value))
-        install = module_info.get('install_enable')
-        if not install:
-            continue
-        output_result.append(module_info)
 
-    # get post process modules info
-    post_process_modules = _get_post_process_modules_info(
-        post_process_modules_info_files, depfiles)
-    for _module_info in post_process_modules:
-        install = _module_info.get('install_enable')
-        if not install:
-            continue
-        output_result.append(_module_info)
+def _collect_install_files(output_result, platform_installed_path,
+                           additional_system_files, depfiles):
+    """Returns (copies, symlinks, dest_list) of the modules to install.
 
+    copies maps each installed path to its source, a later module wins.
+    symlinks maps each link path to its target, the first module wins and a
+    link never replaces an installed file.
+    """
+    copies = {}
+    symlinks = {}
+    dest_list = []
     for source, system_path in additional_system_files:
-        shutil.copy(source, os.path.join(platform_installed_path, system_path))
+        copies[os.path.join(platform_installed_path, system_path)] = source
 
-    # copy modules
     for module_info in output_result:
         if module_info.get('type') == 'none':
             continue
@@ -106,24 +98,258 @@ def copy_modules(system_install_info, install_modules_info_file,
             if dest.startswith('/'):
                 dest = dest[1:]
             dest_list.append(dest)
-            # dest_dir_prefix
-            dest_dir = os.path.join(platform_installed_path,
-                                    os.path.dirname(dest))
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            shutil.copy(source, os.path.join(platform_installed_path, dest))
+            copies[os.path.join(platform_installed_path, dest)] = source
 
         # add symlink
-        if 'symlink' in module_info:
-            symlink_dest = module_info.get('symlink')
-            for dest in dests:
-                symlink_src_file = os.path.basename(dest)
-                for name in symlink_dest:
-                    symlink_dest_dir = os.path.dirname(dest)
-                    symlink_dest_file = os.path.join(platform_installed_path,
-                                                     symlink_dest_dir, name)
-                    if not os.path.exists(symlink_dest_file):
-                        os.symlink(symlink_src_file, symlink_dest_file)
+        for dest in dests:
+            symlink_src_file = os.path.basename(dest)
+            for name in module_info.get('symlink', []):
+                symlink_dest_file = os.path.join(platform_installed_path,
+                                                 os.path.dirname(dest), name)
+                symlinks.setdefault(symlink_dest_file, symlink_src_file)
+
+    for symlink_dest_file in [link for link in symlinks if link in copies]:
+        del symlinks[symlink_dest_file]
+    return copies, symlinks, dest_list
+
+
+def _make_dest_dirs(dests):
+    for dest_dir in sorted(set(os.path.dirname(dest) for dest in dests)):
+        os.makedirs(dest_dir, exist_ok=True)
+
+
+def _copy_file(source, dest, link_mode):
+    if link_mode == 'copy':
+        shutil.copy(source, dest)
+        return 'copy'
+    return file_utils.link_or_copy_file(source, dest, link_mode)
+
+
+def _print_install_methods(methods):
+    counts = collections.Counter(method for method in methods if method)
+    if counts:
+        print('installed {} files: {}'.format(
+            sum(counts.values()), ', '.join(
+                '{} {}'.format(count, method)
+                for method, count in sorted(counts.items()))))
+
+
+def _install_all(copies, symlinks, link_mode, jobs):
+    _make_dest_dirs(copies)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        methods = list(
+            pool.map(lambda item: _copy_file(item[1], item[0], link_mode),
+                     copies.items()))
+    _print_install_methods(methods)
+    for symlink_dest_file, symlink_src_file in symlinks.items():
+        if not os.path.exists(symlink_dest_file):
+            os.symlink(symlink_src_file, symlink_dest_file)
+
+
+def _load_install_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r') as input_f:
+            manifest = json.load(input_f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != _INSTALL_MANIFEST_VERSION or \
+            manifest.get('hash_algorithm') != hash_utils.FAST_ALGORITHM:
+        return None
+    return manifest
+
+
+def _install_record(source, dest):
+    source_st = os.stat(source)
+    return {
+        'source': source,
+        'size': source_st.st_size,
+        'mtime_ns': source_st.st_mtime_ns,
+        'mode': stat.S_IMODE(source_st.st_mode),
+        'hash': hash_utils.file_digest(source),
+        'dest_mtime_ns': os.lstat(dest).st_mtime_ns,
+    }
+
+
+def _install_file(source, dest, link_mode):
+    """Installs source at dest, returns the method and the manifest record."""
+    # never write through a previous install, it may be linked elsewhere
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    method = _copy_file(source, dest, link_mode)
+    return method, _install_record(source, dest)
+
+
+def _is_installed(record, source, dest):
+    """Whether dest still holds the content of source, updates record."""
+    try:
+        dest_st = os.lstat(dest)
+        source_st = os.stat(source)
+    except OSError:
+        return False
+    if not stat.S_ISREG(dest_st.st_mode) \
+            or dest_st.st_size != record['size'] \
+            or dest_st.st_mtime_ns != record['dest_mtime_ns'] \
+            or source_st.st_size != record['size'] \
+            or stat.S_IMODE(source_st.st_mode) != record['mode']:
+        return False
+    if record['source'] == source and \
+            source_st.st_mtime_ns == record['mtime_ns']:
+        return True
+    # relinked or moved, but maybe with the same bytes
+    if hash_utils.file_digest(source) != record['hash']:
+        return False
+    record['source'] = source
+    record['mtime_ns'] = source_st.st_mtime_ns
+    return True
+
+
+def _remove_installed(path, platform_installed_path):
+    if os.path.lexists(path):
+        os.unlink(path)
+    # drop directories the removal left empty
+    stop = os.path.abspath(platform_installed_path)
+    parent = os.path.dirname(os.path.abspath(path))
+    while parent.startswith(stop + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def _new_install_manifest(files, symlinks, platform_installed_path):
+    return {
+        'version': _INSTALL_MANIFEST_VERSION,
+        'hash_algorithm': hash_utils.FAST_ALGORITHM,
+        'files': files,
+        'symlinks': {
+            os.path.relpath(link, platform_installed_path): target
+            for link, target in symlinks.items()
+        },
+    }
+
+
+def _install_incremental(copies, symlinks, manifest, platform_installed_path,
+                         link_mode, jobs):
+    """Brings the installed tree from |manifest| to |copies| and |symlinks|.
+
+    Returns (new manifest, list of installed paths that changed).
+    """
+    old_files = manifest.get('files', {})
+    old_symlinks = manifest.get('symlinks', {})
+    files = {}
+    changed = []
+
+    def _rel(path):
+        return os.path.relpath(path, platform_installed_path)
+
+    new_rels = set(_rel(path) for path in copies)
+    new_rels.update(_rel(path) for path in symlinks)
+    for rel in list(old_files) + list(old_symlinks):
+        if rel not in new_rels:
+            path = os.path.join(platform_installed_path, rel)
+            _remove_installed(path, platform_installed_path)
+            changed.append(path)
+
+    def _update(item):
+        dest, source = item
+        record = old_files.get(_rel(dest))
+        if record is not None and _is_installed(record, source, dest):
+            return None, record
+        return _install_file(source, dest, link_mode)
+
+    _make_dest_dirs(copies)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(_update, copies.items()))
+    for dest, (method, record) in zip(copies, results):
+        files[_rel(dest)] = record
+        if method:
+            changed.append(dest)
+    _print_install_methods(method for method, _ in results)
+
+    for symlink_dest_file, symlink_src_file in symlinks.items():
+        rel = _rel(symlink_dest_file)
+        if os.path.islink(symlink_dest_file) and \
+                os.readlink(symlink_dest_file) == symlink_src_file:
+            continue
+        if os.path.lexists(symlink_dest_file):
+            if rel not in old_files and rel not in old_symlinks:
+                # not installed by us, leave it as a full install would
+                continue
+            os.unlink(symlink_dest_file)
+        os.makedirs(os.path.dirname(symlink_dest_file), exist_ok=True)
+        os.symlink(symlink_src_file, symlink_dest_file)
+        changed.append(symlink_dest_file)
+
+    return _new_install_manifest(files, symlinks,
+                                 platform_installed_path), changed
+
+
+def copy_modules(system_install_info,
+                 install_modules_info_file,
+                 modules_info_file,
+                 module_list_file,
+                 post_process_modules_info_files,
+                 platform_installed_path,
+                 additional_system_files,
+                 depfiles,
+                 install_manifest=None,
+                 link_mode='copy',
+                 jobs=None):
+    """Installs the modules into platform_installed_path.
+
+    With |install_manifest| (the manifest of the previous install, {} for
+    none) only changed files are copied and the new manifest and the changed
+    paths are returned; otherwise everything is copied and (None, None) is
+    returned. Files are copied on |jobs| threads, other |link_mode|s than
+    'copy' link the installed files to the build outputs where possible.
+    """
+    output_result = []
+
+    modules_info_dict = _get_modules_info(system_install_info, depfiles)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        module_infos = list(
+            pool.map(read_json_file, modules_info_dict.values()))
+    for value, module_info in zip(modules_info_dict.values(), module_infos):
+        if not module_info:
+            raise Exception(
+                "read module install info file '{}' error.".format(value))
+        install = module_info.get('install_enable')
+        if not install:
+            continue
+        output_result.append(module_info)
+
+    # get post process modules info
+    post_process_modules = _get_post_process_modules_info(
+        post_process_modules_info_files, depfiles)
+    for _module_info in post_process_modules:
+        install = _module_info.get('install_enable')
+        if not install:
+            continue
+        output_result.append(_module_info)
+
+    copies, symlinks, dest_list = _collect_install_files(
+        output_result, platform_installed_path, additional_system_files,
+        depfiles)
+    new_manifest, changed = None, None
+    if install_manifest is None:
+        _install_all(copies, symlinks, link_mode, jobs)
+    elif not install_manifest:
+        _install_all(copies, symlinks, link_mode, jobs)
+        files = {
+            os.path.relpath(dest, platform_installed_path):
+            _install_record(source, dest)
+            for dest, source in copies.items()
+        }
+        new_manifest = _new_install_manifest(files, symlinks,
+                                             platform_installed_path)
+        changed = list(copies) + list(symlinks)
+    else:
+        new_manifest, changed = _install_incremental(
+            copies, symlinks, install_manifest, platform_installed_path,
+            link_mode, jobs)
 
     # write install module info to file
     write_json_file(install_modules_info_file, modules_info_dict)
@@ -133,6 +359,7 @@ def copy_modules(system_install_info, install_modules_info_file,
 
     # output module list to file
     write_file(module_list_file, '\n'.join(dest_list))
+    return new_manifest, changed
 
 
 def main():
@@ -156,7 +383,26 @@ def main():
     parser.add_argument('--post-process-modules-info-files',
                         nargs='*',
                         default=[])
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='only install modules that changed since the '
+                        'last install')
+    parser.add_argument('--install-manifest-file',
+                        help='installed files of the last incremental install')
+    parser.add_argument('--link-mode',
+                        choices=file_utils.LINK_MODES,
+                        default='copy',
+                        help='hardlink or reflink installed files to the '
+                        'build outputs instead of copying them, only safe '
+                        'when nothing modifies the installed tree in place')
+    parser.add_argument('--jobs', type=int, help='number of copy threads')
+    parser.add_argument('--system-files-manifest',
+                        help='write the installed files of the system dir '
+                        'here, for packagers that read the installed tree')
     args = parser.parse_args()
+    if args.incremental and not args.install_manifest_file:
+        args.install_manifest_file = os.path.join(
+            args.platform_installed_path, 'modules_install_manifest.json')
 
     additional_system_files = []
     for tuple in args.additional_system_files or []:
@@ -174,40 +420,56 @@ def main():
         raise Exception("read file '{}' failed.".format(
             args.system_install_info_file))
 
-    system_install_base_dir = args.system_dir
-    if os.path.exists(system_install_base_dir):
-        shutil.rmtree(system_install_base_dir)
-        print('remove system dir...')
-    os.makedirs(system_install_base_dir)
-
-    vendor_install_base_dir = os.path.join(args.platform_installed_path,
-                                           'vendor')
-    if os.path.exists(vendor_install_base_dir):
-        shutil.rmtree(vendor_install_base_dir)
-        print('remove vendor dir...')
-
-    updater_install_base_dir = os.path.join(args.platform_installed_path,
-                                            'updater')
-    if os.path.exists(updater_install_base_dir):
-        shutil.rmtree(updater_install_base_dir)
-        print('remove updater dir...')
-
-    ramdisk_install_base_dir = os.path.join(args.platform_installed_path,
-                                            'ramdisk')
-    if os.path.exists(ramdisk_install_base_dir):
-        shutil.rmtree(ramdisk_install_base_dir)
-        print('remove ramdisk dir...')
+    install_manifest = None
+    if args.incremental:
+        install_manifest = _load_install_manifest(args.install_manifest_file)
+        if install_manifest is None:
+            print('no install manifest, installing all modules...')
+            install_manifest = {}
+        elif os.path.exists(args.install_manifest_file):
+            # an interrupted install leaves no manifest and starts over
+            os.unlink(args.install_manifest_file)
+
+    install_base_dirs = [
+        args.system_dir,
+        os.path.join(args.platform_installed_path, 'vendor'),
+        os.path.join(args.platform_installed_path, 'updater'),
+        os.path.join(args.platform_installed_path, 'ramdisk'),
+    ]
+    if not install_manifest:
+        for install_base_dir in install_base_dirs:
+            if os.path.exists(install_base_dir):
+                shutil.rmtree(install_base_dir)
+                print('remove {} dir...'.format(
+                    os.path.basename(install_base_dir)))
+    os.makedirs(args.system_dir, exist_ok=True)
 
     print('copy modules...')
-    copy_modules(system_install_info, args.install_modules_info_file,
-                 args.modules_info_file, args.modules_list_file,
-                 args.post_process_modules_info_files,
-                 args.platform_installed_path, additional_system_files,
-                 depfiles)
-
-    if os.path.exists(args.system_image_zipfile):
-        os.unlink(args.system_image_zipfile)
-    build_utils.zip_dir(args.system_image_zipfile, args.system_dir)
+    new_manifest, changed = copy_modules(
+        system_install_info, args.install_modules_info_file,
+        args.modules_info_file, args.modules_list_file,
+        args.post_process_modules_info_files, args.platform_installed_path,
+        additional_system_files, depfiles, install_manifest, args.link_mode,
+        args.jobs)
+
+    system_dir = os.path.abspath(args.system_dir)
+    system_changed = changed is None or any(
+        os.path.abspath(path).startswith(system_dir + os.sep)
+        for path in changed)
+    if args.system_files_manifest:
+        installed_files.write_manifest(args.system_files_manifest,
+                                       args.system_dir)
+    if new_manifest is not None:
+        print('{} installed files changed'.format(len(changed)))
+    if system_changed or not os.path.exists(args.system_image_zipfile):
+        if os.path.exists(args.system_image_zipfile):
+            os.unlink(args.system_image_zipfile)
+        build_utils.zip_dir(args.system_image_zipfile, args.system_dir)
+    else:
+        print('system dir unchanged, keep system image zipfile')
+        os.utime(args.system_image_zipfile)
+    if new_manifest is not None:
+        write_json_file(args.install_manifest_file, new_manifest)
     depfiles.extend([item for item in depfiles if item not in sa_files])
     build_utils.write_depfile(args.depfile, args.install_modules_info_file,
                               depfiles)
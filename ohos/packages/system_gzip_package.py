@@ -14,15 +14,31 @@
 # limitations under the License.
 
 import argparse
+import calendar
 import sys
 import os
 import shutil
+import stat
 import tarfile
+import time
+import zipfile
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None  # pylint: disable=invalid-name
 
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(
         os.path.abspath(__file__)))))
 from scripts.util import build_utils  # noqa: E402
+from scripts.util import installed_files  # noqa: E402
+from scripts.util import parallel_gzip  # noqa: E402
+
+# build_utils.HERMETIC_TIMESTAMP as a unix time
+_REPRODUCIBLE_MTIME = calendar.timegm(
+    tuple(build_utils.HERMETIC_TIMESTAMP) + (0, 0, 0))
 
 
 def merge_image_files(src_image_path, dest_image_path):
@@ -48,18 +64,136 @@ def merge_image_files(src_image_path, dest_image_path):
                 shutil.copy2(src_file_path, dest_file_path)
 
 
-def compress_image_files(package_dir, output_file, additional_files):
-    # Compress the image folder
-    files = [package_dir] + additional_files
-    with tarfile.open(output_file, "w:gz") as tar:
-        for f in files:
+def _owner_info():
+    # what tarfile.gettarinfo() records for files of the current user
+    tarinfo = tarfile.TarInfo()
+    tarinfo.uid = os.getuid()
+    tarinfo.gid = os.getgid()
+    if pwd:
+        try:
+            tarinfo.uname = pwd.getpwuid(tarinfo.uid)[0]
+        except KeyError:
+            pass
+    if grp:
+        try:
+            tarinfo.gname = grp.getgrgid(tarinfo.gid)[0]
+        except KeyError:
+            pass
+    return tarinfo
+
+
+def _new_tarinfo(name, owner, mtime):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.uid, tarinfo.gid = owner.uid, owner.gid
+    tarinfo.uname, tarinfo.gname = owner.uname, owner.gname
+    tarinfo.mtime = mtime
+    return tarinfo
+
+
+def _reproducible_tarinfo(tarinfo):
+    tarinfo.mtime = _REPRODUCIBLE_MTIME
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+
+def _keep_tarinfo(tarinfo):
+    return tarinfo
+
+
+def add_zip_to_tar(tar, zip_path, arcname, tarinfo_filter=_keep_tarinfo):
+    """Adds the files of |zip_path| below |arcname| without extracting them.
+
+    Entries come in the order tar.add() would walk the extracted tree.
+    """
+    owner = _owner_info()
+    mtime = int(time.time())
+    with zipfile.ZipFile(zip_path) as zip_file:
+        infos = {}
+        dirs = set()
+        for info in zip_file.infolist():
+            if info.filename.endswith('/'):
+                dirs.add(info.filename.rstrip('/'))
+            else:
+                infos[info.filename] = info
+        dirs.update(installed_files.directories_of(infos))
+
+        root_info = _new_tarinfo(arcname, owner, mtime)
+        root_info.type = tarfile.DIRTYPE
+        root_info.mode = 0o755
+        tar.addfile(tarinfo_filter(root_info))
+        for name in installed_files.sorted_paths(dirs.union(infos)):
+            tarinfo = _new_tarinfo('{}/{}'.format(arcname, name), owner,
+                                   mtime)
+            info = infos.get(name)
+            if info is None:
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = 0o755
+                tar.addfile(tarinfo_filter(tarinfo))
+                continue
+            mode = info.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                tarinfo.type = tarfile.SYMTYPE
+                tarinfo.mode = 0o777
+                tarinfo.linkname = zip_file.read(info).decode('utf-8')
+                tar.addfile(tarinfo_filter(tarinfo))
+                continue
+            tarinfo.mode = stat.S_IMODE(mode) or 0o644
+            tarinfo.size = info.file_size
+            with zip_file.open(info) as source:
+                tar.addfile(tarinfo_filter(tarinfo), source)
+
+
+def add_installed_files_to_tar(tar,
+                               manifest_file,
+                               arcname,
+                               tarinfo_filter=_keep_tarinfo):
+    """Adds the installed files listed in |manifest_file| below |arcname|."""
+    root_dir, entries = installed_files.read_manifest(manifest_file)
+    paths = [entry['path'] for entry in entries]
+    tar.add(root_dir, arcname=arcname, recursive=False, filter=tarinfo_filter)
+    dirs = installed_files.directories_of(paths)
+    for path in installed_files.sorted_paths(dirs.union(paths)):
+        tar.add(os.path.join(root_dir, path),
+                arcname='{}/{}'.format(arcname, path),
+                recursive=False,
+                filter=tarinfo_filter)
+
+
+def compress_image_files(system_image_zipfile,
+                         system_files_manifest,
+                         output_file,
+                         additional_files,
+                         level=9,
+                         jobs=None,
+                         reproducible=False):
+    """Writes the system tree and |additional_files| to a tar.gz.
+
+    The gzip stream is compressed on |jobs| threads. |reproducible| fixes
+    mtimes and owners, so equal inputs give identical archives.
+    """
+    tarinfo_filter = _keep_tarinfo
+    gzip_mtime = time.time()
+    if reproducible:
+        tarinfo_filter = _reproducible_tarinfo
+        gzip_mtime = 0
+    with open(output_file, 'wb') as output_f, \
+            parallel_gzip.ParallelGzipWriter(output_f, level, gzip_mtime,
+                                             jobs) as gz_file, \
+            tarfile.open(fileobj=gz_file, mode='w') as tar:
+        if system_files_manifest:
+            add_installed_files_to_tar(tar, system_files_manifest, 'system',
+                                       tarinfo_filter)
+        else:
+            add_zip_to_tar(tar, system_image_zipfile, 'system',
+                           tarinfo_filter)
+        for f in additional_files:
             if os.path.exists(f):
                 try:
                     # additional files will be packed outside of system dir.
-                    if f in additional_files:
-                        tar.add(f, arcname=os.path.basename(f))
-                    else:
-                        tar.add(f, arcname='system')
+                    tar.add(f,
+                            arcname=os.path.basename(f),
+                            filter=tarinfo_filter)
                 except OSError as ioerr:
                     print("Compress file failed. Error code: {}".format(
                         ioerr.errno))
@@ -73,25 +207,41 @@ def main(argv):
     parser = argparse.ArgumentParser()
     build_utils.add_depfile_option(parser)
     parser.add_argument('--image-dir', help='', required=True)
-    parser.add_argument("--system-image-zipfile", required=True)
+    parser.add_argument("--system-image-zipfile")
+    parser.add_argument('--system-files-manifest',
+                        help='installed files manifest written by '
+                        'modules_install.py, packs the installed system dir '
+                        'instead of the system image zipfile')
     parser.add_argument('--output-file', help='', required=True)
     parser.add_argument('--additional-files', help='', action='append')
+    parser.add_argument('--compress-level',
+                        type=int,
+                        default=9,
+                        choices=range(1, 10),
+                        help='gzip compression level')
+    parser.add_argument('--jobs', type=int, help='number of gzip threads')
+    parser.add_argument('--reproducible',
+                        action='store_true',
+                        help='fixed mtimes and owners in the archive')
     args = parser.parse_args(argv[1:])
+    if not args.system_image_zipfile and not args.system_files_manifest:
+        parser.error('--system-image-zipfile or --system-files-manifest '
+                     'is required')
 
-    depfiles = [args.system_image_zipfile] + args.additional_files
-    with build_utils.temp_dir() as img_dir:
-        build_utils.extract_all(args.system_image_zipfile,
-                                img_dir,
-                                no_clobber=True)
-        build_utils.call_and_write_depfile_if_stale(
-            lambda: compress_image_files(img_dir, args.output_file, args.
-                                         additional_files),
-            args,
-            depfile_deps=depfiles,
-            input_paths=depfiles,
-            output_paths=([args.output_file]),
-            force=False,
-            add_pydeps=False)
+    additional_files = args.additional_files or []
+    depfiles = [args.system_files_manifest or args.system_image_zipfile
+                ] + additional_files
+    build_utils.call_and_write_depfile_if_stale(
+        lambda: compress_image_files(
+            args.system_image_zipfile, args.system_files_manifest,
+            args.output_file, additional_files, args.compress_level,
+            args.jobs, args.reproducible),
+        args,
+        depfile_deps=depfiles,
+        input_paths=depfiles,
+        output_paths=([args.output_file]),
+        force=False,
+        add_pydeps=False)
 
 
 if __name__ == "__main__":
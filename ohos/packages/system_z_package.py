@@ -17,19 +17,56 @@ import argparse
 import sys
 import os
 import shutil
+import stat
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.dirname(
         os.path.abspath(__file__)))))
 from scripts.util import build_utils  # noqa: E402
 from scripts.util import file_utils  # noqa: E402
+from scripts.util import installed_files  # noqa: E402
 
 
-def archive_files(system_image_zipfile, additional_files, output_dir,
-                  output_file):
+def _copy_installed_files(system_files_manifest, dest_dir):
+    """Copies the installed files of the manifest, skipping unchanged ones."""
+    root_dir, entries = installed_files.read_manifest(system_files_manifest)
+    for entry in entries:
+        src = os.path.join(root_dir, entry['path'])
+        dest = os.path.join(dest_dir, entry['path'])
+        if entry['type'] == 'symlink':
+            if os.path.islink(dest) and os.readlink(dest) == entry['target']:
+                continue
+        else:
+            try:
+                dest_st = os.lstat(dest)
+                if stat.S_ISREG(dest_st.st_mode) \
+                        and dest_st.st_size == entry['size'] \
+                        and dest_st.st_mtime_ns == entry['mtime_ns'] \
+                        and stat.S_IMODE(dest_st.st_mode) == entry['mode']:
+                    continue
+            except OSError:
+                pass
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        if entry['type'] == 'symlink':
+            os.symlink(entry['target'], dest)
+        else:
+            # copy2 keeps the mtime the next run compares against
+            shutil.copy2(src, dest)
+
+
+def archive_files(system_image_zipfile, system_files_manifest,
+                  additional_files, output_dir, output_file):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    build_utils.extract_all(system_image_zipfile, output_dir + "/system", no_clobber=False)
+    if system_files_manifest:
+        _copy_installed_files(system_files_manifest, output_dir + "/system")
+    else:
+        build_utils.extract_all(system_image_zipfile,
+                                output_dir + "/system",
+                                no_clobber=False,
+                                skip_unchanged=True)
     for _file in additional_files:
         _dest = os.path.join(output_dir, os.path.basename(_file))
         if os.path.isdir(_file):
@@ -50,15 +87,25 @@ def main(argv):
     argv = build_utils.expand_file_args(argv)
     parser = argparse.ArgumentParser()
     build_utils.add_depfile_option(parser)
-    parser.add_argument("--system-image-zipfile", required=True)
+    parser.add_argument("--system-image-zipfile")
+    parser.add_argument('--system-files-manifest',
+                        help='installed files manifest written by '
+                        'modules_install.py, copies from the installed system '
+                        'dir instead of extracting the system image zipfile')
     parser.add_argument('--output-dir', required=True)
     parser.add_argument('--output-file', required=True)
     parser.add_argument('--additional-files', action='append')
     args = parser.parse_args(argv[1:])
+    if not args.system_image_zipfile and not args.system_files_manifest:
+        parser.error('--system-image-zipfile or --system-files-manifest '
+                     'is required')
 
-    depfiles = [args.system_image_zipfile] + args.additional_files
+    additional_files = args.additional_files or []
+    depfiles = [args.system_files_manifest or args.system_image_zipfile
+                ] + additional_files
     build_utils.call_and_write_depfile_if_stale(
-        lambda: archive_files(args.system_image_zipfile, args.additional_files,
+        lambda: archive_files(args.system_image_zipfile, args.
+                              system_files_manifest, additional_files,
                               args.output_dir, args.output_file),
         args,
         depfile_deps=depfiles,
@@ -15,25 +15,18 @@
 
 import sys
 import os
-import hashlib
 import argparse
 
+from util import hash_utils
+
 
 class InterfaceMgr:
-    __max_buf = 1024 * 1024
 
     def get_file_sha256(self, filename):
         hash_value = None
         if os.path.isfile(filename):
-            sha256obj = hashlib.sha256()
             try:
-                with open(filename, 'rb') as f:
-                    while True:
-                        buf = f.read(self.__max_buf)
-                        if not buf:
-                            break
-                        sha256obj.update(buf)
-                    hash_value = sha256obj.hexdigest()
+                hash_value = hash_utils.file_digest(filename, 'sha256')
             except OSError as err:
                 sys.stdout.write("read file failed. {}".format(err))
                 return ""
@@ -1,141 +1,514 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
-# Copyright (c) 2021 Huawei Device Co., Ltd.
-# Licensed under the Apache License, Version 2.0 (the "License");
-# you may not use this file except in compliance with the License.
-# You may obtain a copy of the License at
-#
-#     http://www.apache.org/licenses/LICENSE-2.0
-#
-# Unless required by applicable law or agreed to in writing, software
-# distributed under the License is distributed on an "AS IS" BASIS,
-# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
-# See the License for the specific language governing permissions and
-# limitations under the License.
-
-import os
-import sys
-import json
-import gzip
-import shutil
-import argparse
-
-KFILESIGNATURE = "# ninja log v5\n"
-
-
-class StoringDataLine(object):
-    def __init__(self, start, end):
-        self.start = int(start)
-        self.end = int(end)
-        self.target_obj_names = []
-
-    def __str__(self):
-        return "{} {} {} ".format(self.start, self.end, self.target_obj_names)
-
-
-class NinjaToTrace(object):
-    def __init__(self):
-        self.datalist = list()
-        self.durations = list()
-
-    def parse_file(self, filename, ninja_start_time):
-        # ensure file exist
-        if not os.path.exists(filename):
-            print("file: {} not exists".format(filename))
-            return False
-        storing_data = {}
-        with open(filename, mode='r') as f:
-            firstline = f.readline()
-            if firstline != KFILESIGNATURE:
-                print("unrecognized ninja log format, we need {}".format(
-                    KFILESIGNATURE))
-
-            for _, line in enumerate(f.readlines()):
-                start, end, time_stamp, name, cmdhash = line.strip().split(
-                    '\t')
-                if time_stamp < ninja_start_time:
-                    continue
-                storing_data.setdefault(cmdhash, StoringDataLine(start, end))
-                storing_data.get(cmdhash).target_obj_names.append(name)
-
-        self.datalist = sorted(storing_data.values(),
-                               key=lambda line: line.start)
-        self.durations = sorted(storing_data.values(),
-                                key=lambda line: line.end - line.start,
-                                reverse=True)
-        return True
-
-    def save_durations(self, duration_file):
-        total_time = 0
-        with open(duration_file, 'w') as file:
-            for item in self.durations:
-                duration = item.end - item.start
-                total_time += duration
-                file.write('{}: {}\n'.format(item.target_obj_names[0],
-                                             duration))
-            file.write('total time: {} ms'.format(total_time))
-
-    def trans_to_trace_json(self, dest_file_name):
-        counter = CountingTheTid()
-        tracelist = list()
-        for storingdataline in self.datalist:
-            tracelist.append({
-                'name': '%0s' % ', '.join(storingdataline.target_obj_names),
-                'cat': 'targets',
-                'ph': 'X',
-                'ts': str(storingdataline.start * 1000),
-                'dur': str((storingdataline.end - storingdataline.start) * 1000),
-                'pid': str(0),
-                'tid': str(counter.counting_the_new_tid(storingdataline)),
-                'args': {},
-            })
-
-        if not dest_file_name.endswith('.gz'):
-            dest_file_name = dest_file_name + '.gz'
-
-        if os.path.exists(dest_file_name):
-            shutil.move(
-                dest_file_name, '%s/build.trace.%d.gz' %
-                                (os.path.dirname(dest_file_name),
-                                 int(os.stat(dest_file_name).st_mtime)))
-
-        with gzip.open(dest_file_name, "wt") as f:
-            json.dump(tracelist, f)
-
-
-class CountingTheTid(object):
-    def __init__(self):
-        self.tids = []  # store the tid's end time
-
-    def counting_the_new_tid(self, storingdataline):
-        for i in range(len(self.tids)):
-            if self.tids[i] <= storingdataline.start:
-                self.tids[i] = storingdataline.end
-                return i  # renew the endtime and return the current tid
-
-        # for the end time is newer than all tids so we need a new one
-        self.tids.append(storingdataline.end)
-        return len(self.tids) - 1  # the last index of the tids
-
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--ninja-log', help='path to ninja log')
-    parser.add_argument('--trace-file', help='path to build trace file')
-    parser.add_argument('--duration-file', help='path to duration file')
-    parser.add_argument(
-        '--ninja-start-time',
-        help='epoch time of "Starting ninja ..." in nanoseconds')
-
-    options = parser.parse_args()
-    myparser = NinjaToTrace()
-    if not myparser.parse_file(options.ninja_log, options.ninja_start_time):
-        print("parse file fail")
-        return
-
-    myparser.trans_to_trace_json(options.trace_file)
-    myparser.save_durations(options.duration_file)
-
-
-if __name__ == '__main__':
-    sys.exit(main())
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import gzip
+import heapq
+import shutil
+import argparse
+from collections import deque
+
+import ninja_history
+
+KFILESIGNATURE = "# ninja log v5\n"
+
+
+class StoringDataLine(object):
+    __slots__ = ('start', 'end', 'target_obj_names', 'generation', 'cmdhash')
+
+    def __init__(self, start, end, generation=0, cmdhash=None):
+        self.start = int(start)
+        self.end = int(end)
+        self.target_obj_names = []
+        self.generation = generation
+        self.cmdhash = cmdhash
+
+    def __str__(self):
+        return "{} {} {} ".format(self.start, self.end, self.target_obj_names)
+
+
+def read_ninja_log(filename, ninja_start_time=None):
+    """Yields the edges of each build in the log as a dict per build.
+
+    Ninja appends the edges of every build to the same log with times
+    relative to that build's start, so a new build begins where the end
+    time drops. Lines are read one at a time, the outputs of an edge
+    share its command hash.
+    """
+    min_time_stamp = None
+    if ninja_start_time is not None:
+        min_time_stamp = int(ninja_start_time)
+    storing_data = {}
+    last_end = None
+    with open(filename, mode='r') as f:
+        firstline = f.readline()
+        if firstline != KFILESIGNATURE:
+            print("unrecognized ninja log format, we need {}".format(
+                KFILESIGNATURE))
+
+        for line in f:
+            start, end, time_stamp, name, cmdhash = line.strip().split('\t')
+            if min_time_stamp is not None \
+                    and int(time_stamp) < min_time_stamp:
+                continue
+            end = int(end)
+            if last_end is not None and end < last_end and storing_data:
+                yield storing_data
+                storing_data = {}
+            last_end = end
+            data_line = storing_data.get(cmdhash)
+            if data_line is None:
+                data_line = StoringDataLine(start, end, cmdhash=cmdhash)
+                storing_data[cmdhash] = data_line
+            data_line.target_obj_names.append(name)
+    if storing_data:
+        yield storing_data
+
+
+class NinjaToTrace(object):
+    def __init__(self):
+        self.datalist = list()
+        self.durations = list()
+
+    def parse_file(self, filename, ninja_start_time, generations=1):
+        """Loads the last |generations| builds of the log, 0 for all."""
+        # ensure file exist
+        if not os.path.exists(filename):
+            print("file: {} not exists".format(filename))
+            return False
+        kept = deque(maxlen=generations or None)
+        for storing_data in read_ninja_log(filename, ninja_start_time):
+            kept.append(list(storing_data.values()))
+
+        self.datalist = []
+        self.durations = []
+        for generation, data_lines in enumerate(kept):
+            for data_line in data_lines:
+                data_line.generation = generation
+            self.datalist.extend(
+                sorted(data_lines, key=lambda line: line.start))
+            self.durations.extend(data_lines)
+        self.durations.sort(key=lambda line: line.end - line.start,
+                            reverse=True)
+        return True
+
+    def save_durations(self, duration_file):
+        total_time = 0
+        with open(duration_file, 'w') as file:
+            for item in self.durations:
+                duration = item.end - item.start
+                total_time += duration
+                file.write('{}: {}\n'.format(item.target_obj_names[0],
+                                             duration))
+            file.write('total time: {} ms'.format(total_time))
+
+    def _trace_events(self):
+        generations = 0
+        if self.datalist:
+            generations = self.datalist[-1].generation + 1
+        counter = None
+        generation = None
+        for storingdataline in self.datalist:
+            if storingdataline.generation != generation:
+                # lanes restart with every build
+                generation = storingdataline.generation
+                counter = CountingTheTid()
+                if generations > 1:
+                    yield {
+                        'name': 'process_name',
+                        'ph': 'M',
+                        'pid': str(storingdataline.generation),
+                        'args': {
+                            'name': 'build {}'.format(
+                                storingdataline.generation)
+                        },
+                    }
+            yield {
+                'name': '%0s' % ', '.join(storingdataline.target_obj_names),
+                'cat': 'targets',
+                'ph': 'X',
+                'ts': str(storingdataline.start * 1000),
+                'dur': str((storingdataline.end - storingdataline.start) * 1000),
+                'pid': str(storingdataline.generation),
+                'tid': str(counter.counting_the_new_tid(storingdataline)),
+                'args': {},
+            }
+
+    def trans_to_trace_json(self, dest_file_name, compress=True):
+        if compress and not dest_file_name.endswith('.gz'):
+            dest_file_name = dest_file_name + '.gz'
+
+        if os.path.exists(dest_file_name):
+            shutil.move(
+                dest_file_name, '%s/build.trace.%d%s' %
+                                (os.path.dirname(dest_file_name),
+                                 int(os.stat(dest_file_name).st_mtime),
+                                 '.gz' if compress else ''))
+
+        if compress:
+            trace_file = gzip.open(dest_file_name, "wt")
+        else:
+            trace_file = open(dest_file_name, "w")
+        # Written event by event, the same bytes json.dump gives a list.
+        with trace_file as f:
+            f.write('[')
+            for index, event in enumerate(self._trace_events()):
+                if index:
+                    f.write(', ')
+                f.write(json.dumps(event))
+            f.write(']')
+
+
+class CountingTheTid(object):
+    """Puts each edge on the lowest lane that is idle at its start."""
+    def __init__(self):
+        self.busy = []  # (end time, tid) of lanes running an edge
+        self.idle = []  # tids free for the next edge
+        self.tid_count = 0
+
+    def counting_the_new_tid(self, storingdataline):
+        # edges come in start order, a lane idle now stays idle
+        while self.busy and self.busy[0][0] <= storingdataline.start:
+            heapq.heappush(self.idle, heapq.heappop(self.busy)[1])
+        if self.idle:
+            tid = heapq.heappop(self.idle)
+        else:
+            # for the end time is newer than all tids so we need a new one
+            tid = self.tid_count
+            self.tid_count += 1
+        heapq.heappush(self.busy, (storingdataline.end, tid))
+        return tid
+
+
+def _unescape_ninja_paths(text):
+    """Splits a ninja path list on unescaped spaces."""
+    if '$' not in text:
+        return text.split()
+    paths = []
+    current = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == '$' and index + 1 < len(text):
+            # '$ ', '$:' and '$$' stand for the character itself
+            current.append(text[index + 1])
+            index += 2
+            continue
+        if char == ' ':
+            if current:
+                paths.append(''.join(current))
+                current = []
+        else:
+            current.append(char)
+        index += 1
+    if current:
+        paths.append(''.join(current))
+    return paths
+
+
+def _find_build_colon(line):
+    index = 0
+    while index < len(line):
+        if line[index] == '$':
+            index += 2
+            continue
+        if line[index] == ':':
+            return index
+        index += 1
+    return -1
+
+
+def _read_ninja_lines(ninja_file):
+    """Yields the logical lines of a ninja file, continuations joined."""
+    pending = ''
+    with open(ninja_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if pending:
+                line = pending + line.lstrip(' ')
+            stripped = line.rstrip('$')
+            if (len(line) - len(stripped)) % 2:
+                pending = line[:-1]
+                continue
+            pending = ''
+            yield line
+    if pending:
+        yield pending
+
+
+def read_ninja_graph(build_ninja):
+    """Returns {output: [inputs]} of every build statement.
+
+    include and subninja files are read relative to the directory of
+    build_ninja, which is where ninja runs. Implicit and order-only
+    inputs count as dependencies, validations don't.
+    """
+    build_dir = os.path.dirname(os.path.abspath(build_ninja))
+    graph = {}
+    pending_files = [os.path.abspath(build_ninja)]
+    while pending_files:
+        ninja_file = pending_files.pop()
+        for line in _read_ninja_lines(ninja_file):
+            if line.startswith('build '):
+                colon = _find_build_colon(line)
+                if colon < 0:
+                    continue
+                outputs = [
+                    output
+                    for output in _unescape_ninja_paths(line[6:colon])
+                    if output != '|'
+                ]
+                inputs = _unescape_ninja_paths(line[colon + 1:])[1:]
+                if '|@' in inputs:
+                    inputs = inputs[:inputs.index('|@')]
+                inputs = [item for item in inputs if item not in ('|', '||')]
+                for output in outputs:
+                    graph[output] = inputs
+            elif line.startswith('include ') or line.startswith('subninja '):
+                included = line.split(' ', 1)[1].strip()
+                pending_files.append(os.path.join(build_dir, included))
+    return graph
+
+
+class BuildAnalysis(object):
+    """Critical path and parallelism of one build from its ninja log."""
+    def __init__(self, datalist, graph):
+        self.datalist = datalist
+        # every output of a logged edge leads back to its data line
+        producers = {}
+        for index, storingdataline in enumerate(datalist):
+            for name in storingdataline.target_obj_names:
+                producers[name] = index
+        self.weights = [line.end - line.start for line in datalist]
+        self.deps = self._logged_deps(producers, graph)
+        self.order = self._topological_order()
+
+    def _logged_deps(self, producers, graph):
+        """Maps each logged edge to the logged edges it waited for.
+
+        Statements that did not run in this build, like phony targets or
+        up to date outputs, are looked through to the logged edges behind
+        them.
+        """
+        resolved = {}
+
+        def logged_inputs(output):
+            # iterative, dependency chains are far deeper than the
+            # recursion limit
+            if output in resolved:
+                return resolved[output]
+            stack = [(output, False)]
+            while stack:
+                node, expanded = stack.pop()
+                inputs = graph.get(node, [])
+                if not expanded:
+                    if node in resolved:
+                        continue
+                    # None marks a statement whose inputs are in progress
+                    resolved[node] = None
+                    stack.append((node, True))
+                    for item in inputs:
+                        if item not in resolved and item not in producers \
+                                and item in graph:
+                            stack.append((item, False))
+                    continue
+                edges = set()
+                for item in inputs:
+                    if item in producers:
+                        edges.add(producers[item])
+                    elif resolved.get(item):
+                        edges.update(resolved[item])
+                resolved[node] = frozenset(edges)
+            return resolved[output]
+
+        deps = []
+        for storingdataline in self.datalist:
+            edges = set()
+            for name in storingdataline.target_obj_names:
+                for item in graph.get(name, []):
+                    if item in producers:
+                        edges.add(producers[item])
+                    elif item in graph:
+                        edges.update(logged_inputs(item) or ())
+            deps.append(sorted(edges))
+        return deps
+
+    def _topological_order(self):
+        order = []
+        state = [0] * len(self.deps)
+        for root in range(len(self.deps)):
+            if state[root]:
+                continue
+            stack = [(root, 0)]
+            state[root] = 1
+            while stack:
+                node, next_dep = stack.pop()
+                if next_dep < len(self.deps[node]):
+                    stack.append((node, next_dep + 1))
+                    dep = self.deps[node][next_dep]
+                    if not state[dep]:
+                        state[dep] = 1
+                        stack.append((dep, 0))
+                    continue
+                order.append(node)
+        return order
+
+    def _finish_times(self, weights):
+        finish = [0] * len(weights)
+        for node in self.order:
+            dep_finish = 0
+            for dep in self.deps[node]:
+                if finish[dep] > dep_finish:
+                    dep_finish = finish[dep]
+            finish[node] = dep_finish + weights[node]
+        return finish
+
+    def critical_path(self):
+        """Returns (length in ms, [edge indexes]) of the longest chain."""
+        finish = self._finish_times(self.weights)
+        if not finish:
+            return 0, []
+        node = max(range(len(finish)), key=lambda index: finish[index])
+        length = finish[node]
+        path = []
+        while True:
+            path.append(node)
+            if not self.deps[node]:
+                break
+            node = max(self.deps[node], key=lambda index: finish[index])
+        path.reverse()
+        return length, path
+
+    def speedup_candidates(self, path, top):
+        """Returns [(saved ms, edge index)], the build time saved if an
+        edge of the critical path took no time, best first."""
+        length = self._finish_times(self.weights)
+        length = max(length) if length else 0
+        candidates = sorted(path, key=lambda index: self.weights[index],
+                            reverse=True)[:top * 3]
+        gains = []
+        for index in candidates:
+            weights = list(self.weights)
+            weights[index] = 0
+            gains.append((length - max(self._finish_times(weights)), index))
+        gains.sort(key=lambda item: item[0], reverse=True)
+        return gains[:top]
+
+    def parallelism_curve(self, buckets):
+        """Returns [(start ms, end ms, average running edges)]."""
+        if not self.datalist:
+            return []
+        begin = min(line.start for line in self.datalist)
+        end = max(line.end for line in self.datalist)
+        width = max(1, (end - begin + buckets - 1) // buckets)
+        busy = [0] * buckets
+        for line in self.datalist:
+            first = (line.start - begin) // width
+            last = min((line.end - begin) // width, buckets - 1)
+            for bucket in range(first, last + 1):
+                bucket_start = begin + bucket * width
+                overlap = min(line.end, bucket_start + width) - max(
+                    line.start, bucket_start)
+                if overlap > 0:
+                    busy[bucket] += overlap
+        return [(begin + bucket * width, begin + (bucket + 1) * width,
+                 float(busy[bucket]) / width) for bucket in range(buckets)]
+
+    def write_report(self, report_file, top=20, buckets=50):
+        length, path = self.critical_path()
+        total_work = sum(self.weights)
+        wall_time = 0
+        if self.datalist:
+            wall_time = max(line.end for line in self.datalist) - min(
+                line.start for line in self.datalist)
+        lines = [
+            'build time: {} ms, work: {} ms, average parallelism: {:.1f}'.
+            format(wall_time, total_work,
+                   float(total_work) / wall_time if wall_time else 0),
+            'critical path: {} ms over {} edges'.format(length, len(path)),
+        ]
+        for index in path:
+            lines.append('  {:>8} ms  {}'.format(
+                self.weights[index],
+                self.datalist[index].target_obj_names[0]))
+        lines.append('edges that would shorten the build most if sped up:')
+        for saved, index in self.speedup_candidates(path, top):
+            lines.append('  {:>8} ms saved of {:>8} ms  {}'.format(
+                saved, self.weights[index],
+                self.datalist[index].target_obj_names[0]))
+        lines.append('parallelism over time:')
+        for start, end, parallelism in self.parallelism_curve(buckets):
+            lines.append('  {:>8.1f}s - {:>8.1f}s  {:>6.1f}'.format(
+                start / 1000.0, end / 1000.0, parallelism))
+        with open(report_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ninja-log', help='path to ninja log')
+    parser.add_argument('--trace-file', help='path to build trace file')
+    parser.add_argument('--duration-file', help='path to duration file')
+    parser.add_argument(
+        '--ninja-start-time',
+        help='epoch time of "Starting ninja ..." in nanoseconds')
+    parser.add_argument('--generations',
+                        type=int,
+                        default=1,
+                        help='number of most recent builds in the log to '
+                        'trace, each on its own pid, 0 for all')
+    parser.add_argument('--uncompressed',
+                        action='store_true',
+                        help='write plain json instead of gzip')
+    parser.add_argument('--critical-path',
+                        metavar='BUILD_NINJA',
+                        help='build.ninja to join with the log for critical '
+                        'path and parallelism analysis')
+    parser.add_argument('--analysis-file',
+                        help='path to the analysis report, required by '
+                        '--critical-path')
+    parser.add_argument('--history-db',
+                        help='sqlite database to append the edge durations '
+                        'of this build to, see ninja_history.py')
+
+    options = parser.parse_args()
+    myparser = NinjaToTrace()
+    if not myparser.parse_file(options.ninja_log, options.ninja_start_time,
+                               options.generations):
+        print("parse file fail")
+        return
+
+    myparser.trans_to_trace_json(options.trace_file,
+                                 not options.uncompressed)
+    myparser.save_durations(options.duration_file)
+    # the most recent build only, edges of older builds never waited
+    # for each other
+    last_generation = [
+        line for line in myparser.datalist
+        if line.generation == myparser.datalist[-1].generation
+    ] if myparser.datalist else []
+    if options.history_db:
+        ninja_history.record_build(options.history_db, last_generation,
+                                   options.ninja_start_time)
+    if options.critical_path:
+        analysis = BuildAnalysis(last_generation,
+                                 read_ninja_graph(options.critical_path))
+        analysis.write_report(options.analysis_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
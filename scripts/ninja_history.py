@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+
+def _open_db(db_file):
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    os.makedirs(db_dir, exist_ok=True)
+    db = sqlite3.connect(db_file)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS builds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ninja_start_time INTEGER UNIQUE, recorded_at REAL);
+        CREATE TABLE IF NOT EXISTS edges (
+            build_id INTEGER, output TEXT, cmdhash TEXT, duration INTEGER);
+        CREATE INDEX IF NOT EXISTS edges_build ON edges (build_id);
+    ''')
+    return db
+
+
+def record_build(db_file, datalist, ninja_start_time=None):
+    """Appends the edges of one build, keyed by first output and cmdhash.
+
+    Recording the same ninja start time again replaces that build.
+    """
+    if ninja_start_time is not None:
+        ninja_start_time = int(ninja_start_time)
+    db = _open_db(db_file)
+    with db:
+        if ninja_start_time is not None:
+            row = db.execute('SELECT id FROM builds WHERE ninja_start_time = ?',
+                             (ninja_start_time, )).fetchone()
+            if row:
+                db.execute('DELETE FROM edges WHERE build_id = ?', row)
+                db.execute('DELETE FROM builds WHERE id = ?', row)
+        cursor = db.execute(
+            'INSERT INTO builds (ninja_start_time, recorded_at) VALUES (?, ?)',
+            (ninja_start_time, time.time()))
+        build_id = cursor.lastrowid
+        db.executemany(
+            'INSERT INTO edges VALUES (?, ?, ?, ?)',
+            [(build_id, line.target_obj_names[0], line.cmdhash,
+              line.end - line.start) for line in datalist])
+    db.close()
+    return build_id
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def find_regressions(db_file, builds, threshold, min_ms):
+    """Compares the latest build with the median of the |builds| before.
+
+    Returns [(output, baseline ms, latest ms, command changed)] of edges
+    that grew more than |threshold| percent and |min_ms| ms, slowest
+    growth first.
+    """
+    db = _open_db(db_file)
+    build_ids = [
+        row[0] for row in db.execute(
+            'SELECT id FROM builds ORDER BY id DESC LIMIT ?', (builds + 1, ))
+    ]
+    if len(build_ids) < 2:
+        db.close()
+        return []
+    latest = {
+        output: (duration, cmdhash)
+        for output, cmdhash, duration in db.execute(
+            'SELECT output, cmdhash, duration FROM edges WHERE build_id = ?',
+            (build_ids[0], ))
+    }
+    baseline = {}
+    baseline_cmdhash = {}
+    # oldest first, so the newest baseline command hash wins
+    for build_id in reversed(build_ids[1:]):
+        for output, cmdhash, duration in db.execute(
+                'SELECT output, cmdhash, duration FROM edges '
+                'WHERE build_id = ?', (build_id, )):
+            baseline.setdefault(output, []).append(duration)
+            baseline_cmdhash[output] = cmdhash
+    db.close()
+
+    regressions = []
+    for output, (duration, cmdhash) in latest.items():
+        if output not in baseline:
+            continue
+        base = _median(baseline[output])
+        if duration - base < min_ms \
+                or duration <= base * (1 + threshold / 100.0):
+            continue
+        regressions.append(
+            (output, base, duration, cmdhash != baseline_cmdhash[output]))
+    regressions.sort(key=lambda item: item[2] - item[1], reverse=True)
+    return regressions
+
+
+def _read_subsystem_paths(subsystem_config_file):
+    with open(subsystem_config_file, 'r') as input_f:
+        subsystem_config = json.load(input_f)
+    paths = [(info.get('path', '').rstrip('/'), name)
+             for name, info in subsystem_config.items()]
+    # longest prefix first, nested subsystems win over their parents
+    paths.sort(key=lambda item: len(item[0]), reverse=True)
+    return paths
+
+
+def subsystem_of(output, subsystem_paths):
+    """Maps an output like clang_x64/obj/base/foo/x.o to its subsystem."""
+    parts = output.split('/')
+    for marker in ('obj', 'gen'):
+        if marker in parts:
+            parts = parts[parts.index(marker) + 1:]
+            break
+    source_path = '/'.join(parts)
+    for path, name in subsystem_paths:
+        if path and (source_path == path
+                     or source_path.startswith(path + '/')):
+            return name
+    return 'unknown'
+
+
+def print_regressions(regressions, subsystem_paths, top):
+    print('{} edges regressed'.format(len(regressions)))
+    for output, base, duration, changed in regressions[:top]:
+        print('  {:>8.0f} ms -> {:>8} ms  {}{}'.format(
+            base, duration, output,
+            ' (command changed)' if changed else ''))
+    if not subsystem_paths:
+        return
+    by_subsystem = {}
+    for regression in regressions:
+        subsystem = subsystem_of(regression[0], subsystem_paths)
+        by_subsystem.setdefault(subsystem, []).append(regression)
+    ranked = sorted(by_subsystem.items(),
+                    key=lambda item: sum(r[2] - r[1] for r in item[1]),
+                    reverse=True)
+    print('newly slow targets by subsystem:')
+    for subsystem, items in ranked[:top]:
+        print('  {}: +{:.0f} ms over {} edges'.format(
+            subsystem, sum(r[2] - r[1] for r in items), len(items)))
+        for output, base, duration, _ in items[:3]:
+            print('    {:>8.0f} ms -> {:>8} ms  {}'.format(
+                base, duration, output))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='show build edges that got slower across builds')
+    parser.add_argument('--history-db',
+                        required=True,
+                        help='database written by ninja2trace.py')
+    parser.add_argument('--builds',
+                        type=int,
+                        default=5,
+                        help='number of earlier builds to compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=20,
+                        help='minimum growth in percent')
+    parser.add_argument('--min-ms',
+                        type=int,
+                        default=100,
+                        help='minimum growth in milliseconds')
+    parser.add_argument('--subsystem-config',
+                        help='subsystem_config.json to group regressions by')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.history_db):
+        print("file '{}' doesn't exist.".format(args.history_db))
+        return 1
+    subsystem_paths = []
+    if args.subsystem_config:
+        subsystem_paths = _read_subsystem_paths(args.subsystem_config)
+    regressions = find_regressions(args.history_db, args.builds,
+                                   args.threshold, args.min_ms)
+    print_regressions(regressions, subsystem_paths, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -15,31 +15,48 @@
 
 import sys
 import os
+import json
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from scripts.util.file_utils import read_json_file, read_file, write_file  # noqa: E402 E501
+from scripts.util.file_utils import read_json_file, write_file  # noqa: E402
 
 
-def _read_subninja_build(build_dir, subninja_build_file):
-    subninja_build_file = os.path.join(build_dir, subninja_build_file)
+# Library-like outputs that name the target of a subninja file.
+_SUPPORT_LIB_TYPE = ('.a', '.so', '')
+
+# Below this many subninja files a process pool costs more than it saves.
+_MIN_PARALLEL_FILES = 64
+
+_INDEX_VERSION = 1
+
+# Files modified this recently are not cached, a rewrite within the same
+# mtime granularity would go unseen.
+_RACY_LIMIT_NS = 2 * 1000 * 1000 * 1000
+
+
+def _scan_subninja_build(subninja_build_file):
+    """Returns {label_name: label_target} of one target ninja file, or None.
+
+    The file is streamed, label_target is the last build output with a
+    library-like extension.
+    """
     if not os.path.exists(subninja_build_file):
         raise Exception("file '{}' doesn't exist.".format(subninja_build_file))
-    subninja_build = read_file(subninja_build_file)
-    if subninja_build is None:
-        raise Exception("read file '{}' failed.".format(subninja_build_file))
-    support_lib_type = ['.a', '.so', '']
     label_name = ''
     label_target = ''
-    for _line in subninja_build:
-        if _line.startswith('label_name = '):
-            label_name = _line[len('label_name = '):]
-        elif _line.startswith('build '):
-            _build_info = _line.split(':')[0]
-            build_label = _build_info.split(' ')[1]
-            _, extension = os.path.splitext(build_label)
-            if extension in support_lib_type:
-                label_target = build_label
+    with open(subninja_build_file, 'r') as _file:
+        for _line in _file:
+            if _line.startswith('label_name = '):
+                label_name = _line[len('label_name = '):].rstrip('\n')
+            elif _line.startswith('build '):
+                _build_info = _line.split(':')[0]
+                build_label = _build_info.split(' ')[1].rstrip('\n')
+                _, extension = os.path.splitext(build_label)
+                if extension in _SUPPORT_LIB_TYPE:
+                    label_target = build_label
 
     if label_target != '':
         if label_name == '':
@@ -66,32 +83,188 @@ def _parse_target_label(build_label_list, toolchain_name):
     return phony_targets_dict
 
 
-def _read_toolchain_ninja(build_dir, toolchain_ninja_file, toolchain_name):
+def _scan_toolchain_ninja(toolchain_ninja_file):
+    """Returns the .stamp build labels and subninja files, in file order."""
     if not os.path.exists(toolchain_ninja_file):
         raise Exception(
             "file '{}' doesn't exist.".format(toolchain_ninja_file))
-    toolchain_ninja_rules = read_file(toolchain_ninja_file)
-    if toolchain_ninja_rules is None:
-        raise Exception("read file '{}' failed.".format(toolchain_ninja_file))
-
     build_label_list = []
-    subninja_targets = {}
-    for _ninja_rule in toolchain_ninja_rules:
-        if _ninja_rule.startswith('build '):
-            _tmp = _ninja_rule.split(':')[0]
-            _label = _tmp[len('build '):]
-            if not _label.endswith('.stamp'):
+    subninja_files = []
+    with open(toolchain_ninja_file, 'r') as _file:
+        for _ninja_rule in _file:
+            _ninja_rule = _ninja_rule.rstrip('\n')
+            if _ninja_rule.startswith('build '):
+                _tmp = _ninja_rule.split(':')[0]
+                _label = _tmp[len('build '):]
+                if not _label.endswith('.stamp'):
+                    continue
+                build_label_list.append(_label)
+            if _ninja_rule.startswith('subninja '):
+                subninja_files.append(_ninja_rule[len('subninja '):])
+    return build_label_list, subninja_files
+
+
+def _scan_build_ninja(build_ninja_file):
+    """Returns the build target names and subninja lines of build.ninja."""
+    if not os.path.exists(build_ninja_file):
+        raise Exception("file '{}' doesn't exist.".format(build_ninja_file))
+    targets_name = []
+    subninja_lines = []
+    with open(build_ninja_file, 'r') as _file:
+        for _line in _file:
+            _line = _line.rstrip('\n')
+            if _line.startswith('build '):
+                _ninja_target = _line.split(': ')[0]
+                targets_name.append(_ninja_target[len('build '):])
+            elif _line.startswith('subninja '):
+                subninja_lines.append(_line)
+    return targets_name, subninja_lines
+
+
+def _file_stat(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return [file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino]
+
+
+class NinjaTargetIndex(object):
+    """Targets of build.ninja and the given toolchain.ninja files.
+
+    Every file is read once, the subninja files of all toolchains are
+    scanned together in a process pool, and the result is shared by all
+    platforms using the same toolchain. With an index_file, the scan of
+    each file is kept by its (mtime, size, inode), so the next gn gen
+    only rescans the files it changed.
+    """
+    def __init__(self, build_dir, toolchain_ninja_files=None, jobs=None,
+                 index_file=None):
+        self.build_dir = build_dir
+        self.index_file = index_file
+        self._cached_files = self._load_index()
+        # {path relative to build_dir: [stat, scan result]} of this run
+        self._files = {}
+        # files this process wrote itself, gn can't be racing on them
+        self._own_files = set()
+        self.default_targets_name, self.subninja_lines = self._scan_files(
+            ['build.ninja'], _scan_build_ninja)[0]
+        self._toolchains = {}
+        self._subninja_targets = {}
+        self._phony_targets = {}
+        self.add_toolchains(toolchain_ninja_files or [], jobs)
+
+    def _load_index(self):
+        if not self.index_file or not os.path.exists(self.index_file):
+            return {}
+        try:
+            index = read_json_file(self.index_file)
+        except ValueError:
+            # a broken index only costs a full scan
+            return {}
+        if not index or index.get('version') != _INDEX_VERSION:
+            return {}
+        return index.get('files', {})
+
+    def _scan_files(self, rel_paths, scan_fn, jobs=1):
+        """Returns scan_fn of each file, reusing unchanged cached scans."""
+        results = [None] * len(rel_paths)
+        stale = []
+        for index, rel_path in enumerate(rel_paths):
+            file_stat = _file_stat(os.path.join(self.build_dir, rel_path))
+            cached = self._cached_files.get(rel_path)
+            if file_stat is not None and cached and cached[0] == file_stat:
+                results[index] = cached[1]
+                self._files[rel_path] = cached
+            else:
+                stale.append(index)
+                self._files[rel_path] = [file_stat, None]
+
+        paths = [os.path.join(self.build_dir, rel_paths[i]) for i in stale]
+        if jobs > 1 and len(paths) >= _MIN_PARALLEL_FILES:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                scanned = list(
+                    executor.map(scan_fn,
+                                 paths,
+                                 chunksize=max(1, len(paths) // (jobs * 4))))
+        else:
+            scanned = [scan_fn(path) for path in paths]
+        for index, result in zip(stale, scanned):
+            results[index] = result
+            self._files[rel_paths[index]][1] = result
+        return results
+
+    def add_toolchains(self, toolchain_ninja_files, jobs=None):
+        toolchain_ninja_files = [
+            f for f in toolchain_ninja_files if f not in self._toolchains
+        ]
+        scanned = self._scan_files(
+            [os.path.relpath(f, self.build_dir) for f in toolchain_ninja_files],
+            _scan_toolchain_ninja)
+        new_subninja_files = []
+        for toolchain_ninja_file, (build_label_list, subninja_files) in zip(
+                toolchain_ninja_files, scanned):
+            self._toolchains[toolchain_ninja_file] = (build_label_list,
+                                                      subninja_files)
+            for subninja_file in subninja_files:
+                if subninja_file not in self._subninja_targets:
+                    # placeholder keeps each file scanned once
+                    self._subninja_targets[subninja_file] = None
+                    new_subninja_files.append(subninja_file)
+
+        results = self._scan_files(new_subninja_files, _scan_subninja_build,
+                                   jobs or os.cpu_count() or 1)
+        for subninja_file, target_info in zip(new_subninja_files, results):
+            self._subninja_targets[subninja_file] = target_info
+
+    def phony_targets(self, toolchain_ninja_file, toolchain_name):
+        """Returns {target name: build label} of one toolchain."""
+        key = (toolchain_ninja_file, toolchain_name)
+        if key not in self._phony_targets:
+            self.add_toolchains([toolchain_ninja_file])
+            build_label_list, subninja_files = self._toolchains[
+                toolchain_ninja_file]
+            build_phony_targets = _parse_target_label(build_label_list,
+                                                      toolchain_name)
+            for subninja_file in subninja_files:
+                subninja_target_info = self._subninja_targets[subninja_file]
+                if subninja_target_info:
+                    build_phony_targets.update(subninja_target_info)
+            self._phony_targets[key] = build_phony_targets
+        return self._phony_targets[key]
+
+    def build_ninja_updated(self, appended_lines):
+        """Records subninja lines appended to build.ninja by this run."""
+        if not appended_lines:
+            return
+        self.subninja_lines = self.subninja_lines + list(appended_lines)
+        self._files['build.ninja'] = [
+            _file_stat(os.path.join(self.build_dir, 'build.ninja')),
+            [self.default_targets_name, self.subninja_lines]
+        ]
+        self._own_files.add('build.ninja')
+
+    def save(self):
+        """Writes the scans of this run, files of other runs are dropped."""
+        if not self.index_file:
+            return
+        racy_limit = time.time_ns() - _RACY_LIMIT_NS
+        files = {}
+        for rel_path, entry in self._files.items():
+            file_stat = entry[0]
+            if file_stat is None:
+                continue
+            # gn may still rewrite a file within its mtime granularity
+            if file_stat[0] >= racy_limit \
+                    and rel_path not in self._own_files:
                 continue
-            build_label_list.append(_label)
-        if _ninja_rule.startswith('subninja '):
-            sbuninja_file = _ninja_rule[len('subninja '):]
-            subninja_target_info = _read_subninja_build(
-                build_dir, sbuninja_file)
-            if subninja_target_info:
-                subninja_targets.update(subninja_target_info)
-    build_phony_targets = _parse_target_label(build_label_list, toolchain_name)
-    build_phony_targets.update(subninja_targets)
-    return build_phony_targets
+            files[rel_path] = entry
+        tmp_file = '{}.tmp'.format(self.index_file)
+        with open(tmp_file, 'w') as output_f:
+            json.dump({'version': _INDEX_VERSION, 'files': files},
+                      output_f,
+                      separators=(',', ':'))
+        os.replace(tmp_file, self.index_file)
 
 
 def _read_variants_toolchain_info(variants_toolchain_info_file):
@@ -106,55 +279,55 @@ def _read_variants_toolchain_info(variants_toolchain_info_file):
     return platform_toolchain
 
 
-def _read_build_ninja(build_ninja_file):
-    if not os.path.exists(build_ninja_file):
-        raise Exception("file '{}' doesn't exist.".format(build_ninja_file))
-    ninja_targets = read_file(build_ninja_file)
-    if ninja_targets is None:
-        raise Exception("read file '{}' failed.".format(build_ninja_file))
-    return ninja_targets
-
-
 def generate_phony_targets(build_dir, toolchain_ninja_file, platform,
-                           toolchain_name, default_targets_name):
-    build_phony_targets = _read_toolchain_ninja(build_dir,
-                                                toolchain_ninja_file,
-                                                toolchain_name)
+                           toolchain_name, default_targets_name,
+                           target_index=None):
+    if target_index is None:
+        target_index = NinjaTargetIndex(build_dir, [toolchain_ninja_file])
+    build_phony_targets = target_index.phony_targets(toolchain_ninja_file,
+                                                     toolchain_name)
     targets_list = []
     for key, build_label in build_phony_targets.items():
         targets_list.append('build {}/{}: phony {}'.format(
             platform, key, build_label))
 
-    _diff_targets = set(default_targets_name).difference(
-        set(build_phony_targets.keys()))
+    # build.ninja order, a set would reorder the file in every process
+    _diff_targets = [
+        _target for _target in dict.fromkeys(default_targets_name)
+        if _target not in build_phony_targets
+    ]
     for _diff_target in _diff_targets:
         targets_list.append('build {}/{}: phony {}'.format(
             platform, _diff_target, _diff_target))
     build_file = os.path.join(os.path.dirname(toolchain_ninja_file),
                               '{}_build.ninja'.format(platform))
-    write_file(build_file, '{}\n\n'.format('\n'.join(targets_list)))
+    # Unchanged labels leave the file alone, ninja sees no manifest change.
+    write_file(build_file,
+               '{}\n\n'.format('\n'.join(targets_list)),
+               check_changes=True)
     return build_file
 
 
-def _update_build_ninja(build_dir, include_files):
+def _update_build_ninja(build_dir, include_files, subninja_lines):
     try:
         ninja_build_file = os.path.join(build_dir, 'build.ninja')
         if not os.path.exists(ninja_build_file):
             raise Exception(
                 "file '{}' doesn't exist.".format(ninja_build_file))
-        with open(ninja_build_file, 'a+') as _file:
-            data = []
-            for line in _file.readlines():
-                _line = line.rstrip('\n')
-                if _line.startswith('subninja '):
-                    data.append(_line)
+        with open(ninja_build_file, 'a') as _file:
+            # subninja lines already in build.ninja, from the index scan
+            data = set(subninja_lines)
+            appended_lines = []
             for include_file in include_files:
                 include_info = 'subninja {}'.format(
                     os.path.relpath(include_file, build_dir))
                 if include_info in data:
                     continue
                 _file.write('{}\n'.format(include_info))
+                data.add(include_info)
+                appended_lines.append(include_info)
             _file.flush()
+        return appended_lines
     except: # noqa E722
         raise
 
@@ -165,16 +338,7 @@ def update(build_dir, variants_toolchain_info_file):
     platform_toolchain = _read_variants_toolchain_info(
         variants_toolchain_info_file)
 
-    ninja_build_file = os.path.join(build_dir, 'build.ninja')
-    default_ninja_targets = _read_build_ninja(ninja_build_file)
-    default_targets_name = []
-    for _ninja_target in default_ninja_targets:
-        if not _ninja_target.startswith('build '):
-            continue
-        _ninja_target = _ninja_target.split(': ')[0]
-        default_targets_name.append(_ninja_target[len('build '):])
-
-    include_files = []
+    platforms = []
     for platform, toolchain_label in platform_toolchain.items():
         if platform == 'phone':
             continue
@@ -183,11 +347,25 @@ def update(build_dir, variants_toolchain_info_file):
                                             'toolchain.ninja')
         if not os.path.exists(toolchain_ninja_file):
             continue
-        _build_file = generate_phony_targets(build_dir, toolchain_ninja_file,
-                                             platform, toolchain_name,
-                                             default_targets_name)
+        platforms.append((platform, toolchain_name, toolchain_ninja_file))
+
+    # build.ninja and every toolchain are indexed once for all platforms
+    index_file = os.path.join(os.path.dirname(variants_toolchain_info_file),
+                              'ninja_targets_index.json')
+    target_index = NinjaTargetIndex(
+        build_dir, [toolchain_ninja_file for _, _, toolchain_ninja_file
+                    in platforms],
+        index_file=index_file)
+    include_files = []
+    for platform, toolchain_name, toolchain_ninja_file in platforms:
+        _build_file = generate_phony_targets(
+            build_dir, toolchain_ninja_file, platform, toolchain_name,
+            target_index.default_targets_name, target_index)
         include_files.append(_build_file)
-    _update_build_ninja(build_dir, include_files)
+    appended_lines = _update_build_ninja(build_dir, include_files,
+                                         target_index.subninja_lines)
+    target_index.build_ninja_updated(appended_lines)
+    target_index.save()
 
 
 def main():
@@ -6,7 +6,9 @@
 """Contains common helpers for GN action()s."""
 
 import collections
+import concurrent.futures
 import contextlib
+import errno
 from distutils import extension
 import filecmp
 import fnmatch
@@ -16,10 +18,13 @@ import pipes
 import re
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import zipfile
+import zlib
 import optparse
 
 # Any new non-system import must be added to:
@@ -41,6 +46,14 @@ DIR_SOURCE_ROOT = os.environ.get(
 HERMETIC_TIMESTAMP = (2001, 1, 1, 0, 0, 0)
 _HERMETIC_FILE_ATTR = (0o644 << 16)
 
+# Entries read ahead of the zip writer, bounded by count and by bytes.
+_MAX_PENDING_ENTRIES = 256
+_MAX_PENDING_BYTES = 256 * 1024 * 1024
+_COPY_CHUNK_SIZE = 1024 * 1024
+# Files and entries this large are streamed in chunks instead of being
+# held in memory.
+_STREAM_THRESHOLD = 16 * 1024 * 1024
+
 
 @contextlib.contextmanager
 def temp_dir():
@@ -289,11 +302,137 @@ def _is_symlink(zip_file, name):
     return stat.S_ISLNK(zi.external_attr >> 16)
 
 
+def _kernel_copy(in_fd, out_fd, offset, count):
+    """Copies up to |count| bytes at |offset| of |in_fd| without a userspace
+    buffer. Returns the number of bytes copied, 0 when the kernel can't."""
+    copy_fns = []
+    if hasattr(os, 'copy_file_range'):
+        copy_fns.append(
+            lambda: os.copy_file_range(in_fd, out_fd, count, offset))
+    if hasattr(os, 'sendfile'):
+        copy_fns.append(lambda: os.sendfile(out_fd, in_fd, offset, count))
+    for copy_fn in copy_fns:
+        try:
+            return copy_fn()
+        except OSError as e:
+            # e.g. across file systems or on old kernels, try the next one
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    return 0
+
+
+def _copy_range(in_fd, out_fd, offset, count):
+    while count > 0:
+        copied = _kernel_copy(in_fd, out_fd, offset, count)
+        if not copied:
+            break
+        offset += copied
+        count -= copied
+    while count > 0:
+        chunk = os.pread(in_fd, min(count, _COPY_CHUNK_SIZE), offset)
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated zip entry')
+        os.write(out_fd, chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def _entry_data_offset(fd, info):
+    header = os.pread(fd, zipfile.sizeFileHeader, info.header_offset)
+    if len(header) != zipfile.sizeFileHeader or \
+            header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad local header for %s' % info.filename)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + \
+        extra_length
+
+
+def _file_matches_entry(dest, info):
+    """Whether |dest| is a regular file with the size and CRC of |info|."""
+    try:
+        st = os.lstat(dest)
+    except OSError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_size != info.file_size:
+        return False
+    crc = 0
+    with open(dest, 'rb') as f:
+        while True:
+            chunk = f.read(_COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+
+class _ZipExtractor(object):
+    """Extracts entries of one zip file from several threads.
+
+    Every thread gets its own ZipFile and descriptor, stored entries are
+    copied from their recorded offset by the kernel.
+    """
+
+    def __init__(self, zip_path):
+        self._zip_path = zip_path
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def _handle(self):
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            handle = (zipfile.ZipFile(self._zip_path),
+                      os.open(self._zip_path, os.O_RDONLY))
+            self._local.handle = handle
+            with self._lock:
+                self._handles.append(handle)
+        return handle
+
+    def close(self):
+        for zip_file, fd in self._handles:
+            zip_file.close()
+            os.close(fd)
+        self._handles = []
+
+    def extract(self, info, dest):
+        zip_file, fd = self._handle()
+        if info.compress_type == zipfile.ZIP_STORED and \
+                not info.flag_bits & 0x1:
+            offset = _entry_data_offset(fd, info)
+            with open(dest, 'wb') as f:
+                _copy_range(fd, f.fileno(), offset, info.file_size)
+            return
+        with zip_file.open(info) as source, open(dest, 'wb') as f:
+            shutil.copyfileobj(source, f, _COPY_CHUNK_SIZE)
+
+
+def _sanitized_dest(path, name):
+    # ZipFile.extract() drops '..' and empty components the same way
+    parts = [p for p in name.split('/') if p not in ('', '.', '..')]
+    return os.path.join(path, *parts)
+
+
 def extract_all(zip_path,
                 path=None,
                 no_clobber=True,
                 pattern=None,
-                predicate=None):
+                predicate=None,
+                skip_unchanged=False,
+                jobs=None):
+    """Extracts the files of |zip_path| to |path| on a thread pool.
+
+    Args:
+      no_clobber: Fail if a file would be overwritten.
+      pattern: Glob an entry name has to match.
+      predicate: Called with each entry name, entries it rejects are skipped.
+      skip_unchanged: Leave files that already have the size and CRC of their
+          entry untouched, and symlinks that already point to their target.
+      jobs: Number of threads, the thread pool default when None.
+
+    Returns:
+      The list of paths in the zip order, including skipped unchanged ones.
+    """
     if path is None:
         path = os.getcwd()
     elif not os.path.exists(path):
@@ -303,10 +442,14 @@ def extract_all(zip_path,
         raise Exception('Invalid zip file: %s' % zip_path)
 
     extracted = []
+    work = []
+    dirs = set()
+    dests = set()
     with zipfile.ZipFile(zip_path) as z:
-        for name in z.namelist():
+        for info in z.infolist():
+            name = info.filename
             if name.endswith('/'):
-                make_directory(os.path.join(path, name))
+                dirs.add(os.path.join(path, name))
                 continue
             if pattern is not None:
                 if not fnmatch.fnmatch(name, pattern):
@@ -314,23 +457,171 @@ def extract_all(zip_path,
             if predicate and not predicate(name):
                 continue
             _check_zip_path(name)
+            output_path = os.path.join(path, name)
             if no_clobber:
-                output_path = os.path.join(path, name)
-                if os.path.exists(output_path):
+                if os.path.exists(output_path) or output_path in dests:
                     raise Exception('Path already exists from zip: %s %s %s' %
                                     (zip_path, name, output_path))
+            dests.add(output_path)
+            extracted.append(output_path)
             if _is_symlink(z, name):
-                dest = os.path.join(path, name)
-                make_directory(os.path.dirname(dest))
-                os.symlink(z.read(name), dest)
-                extracted.append(dest)
+                dirs.add(os.path.dirname(output_path))
+                work.append((info, output_path, z.read(name)))
             else:
-                z.extract(name, path)
-                extracted.append(os.path.join(path, name))
+                dest = _sanitized_dest(path, name)
+                dirs.add(os.path.dirname(dest))
+                work.append((info, dest, None))
+
+    for dir_path in sorted(dirs):
+        make_directory(dir_path)
+
+    # a later entry of the same name wins, as when extracting in order
+    last_index = {dest: i for i, (_, dest, _) in enumerate(work)}
+    files = []
+    for i, (info, dest, link) in enumerate(work):
+        if last_index[dest] != i:
+            continue
+        if link is not None:
+            if skip_unchanged and os.path.islink(dest) and \
+                    os.fsencode(os.readlink(dest)) == link:
+                continue
+            os.symlink(link, dest)
+        elif not skip_unchanged or not _file_matches_entry(dest, info):
+            files.append((info, dest))
+
+    extractor = _ZipExtractor(zip_path)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(lambda item: extractor.extract(*item), files):
+                pass
+    finally:
+        extractor.close()
 
     return extracted
 
 
+def _deflate(data, level=None):
+    """Compresses |data| the way zipfile does for ZIP_DEFLATED entries."""
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _hermetic_zipinfo(zip_path,
+                      compress_type,
+                      crc,
+                      compress_size,
+                      file_size,
+                      external_attr=_HERMETIC_FILE_ATTR):
+    zipinfo = zipfile.ZipInfo(filename=zip_path, date_time=HERMETIC_TIMESTAMP)
+    zipinfo.external_attr = external_attr
+    zipinfo.compress_type = compress_type
+    zipinfo.CRC = crc
+    zipinfo.compress_size = compress_size
+    zipinfo.file_size = file_size
+    return zipinfo
+
+
+def _write_compressed_entry(zip_file, zipinfo, chunks):
+    """Writes an entry whose CRC, sizes and compressed bytes are known.
+
+    The local header is written once with the final values, which is what
+    ZipFile.writestr() leaves in a seekable output.
+    """
+    # pylint: disable=protected-access
+    zip64 = zip_file._allowZip64 and \
+        zipinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    if zip_file._seekable:
+        zip_file.fp.seek(zip_file.start_dir)
+    zipinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zipinfo)
+    zip_file._didModify = True
+    zip_file.fp.write(zipinfo.FileHeader(zip64))
+    for chunk in chunks:
+        zip_file.fp.write(chunk)
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file.filelist.append(zipinfo)
+    zip_file.NameToInfo[zipinfo.filename] = zipinfo
+
+
+class _OrderedZipWriter(object):
+    """Writes entries to a ZipFile in the order they were added.
+
+    Entries are prepared on |jobs| threads, the caller's thread is the only
+    one writing, so the output does not depend on |jobs|. Read-ahead is
+    bounded by entry count and by bytes.
+    """
+
+    def __init__(self, zip_file, jobs):
+        self._zip_file = zip_file
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._executor = None
+        if jobs > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+
+    def add(self, size, fn, *args):
+        """Queues the entry returned by fn(*args) as (zipinfo, chunks)."""
+        if self._executor:
+            item = self._executor.submit(fn, *args)
+        else:
+            item = fn(*args)
+        self._append(item, size)
+
+    def add_entry(self, size, zipinfo, chunks):
+        """Queues an entry whose compressed bytes are already known."""
+        self._append((zipinfo, chunks), size)
+
+    def write_now(self, fn, *args, **kwargs):
+        """Writes the queued entries, then calls fn(zip_file, ...)."""
+        self.flush()
+        fn(self._zip_file, *args, **kwargs)
+
+    def flush(self):
+        self._flush(0, 0)
+
+    def _append(self, item, size):
+        self._pending.append((item, size))
+        self._pending_bytes += size
+        self._flush(_MAX_PENDING_ENTRIES, _MAX_PENDING_BYTES)
+
+    def _flush(self, max_entries, max_bytes):
+        while self._pending and (len(self._pending) > max_entries
+                                 or self._pending_bytes > max_bytes):
+            item, size = self._pending.popleft()
+            if isinstance(item, concurrent.futures.Future):
+                item = item.result()
+            self._pending_bytes -= size
+            _write_compressed_entry(self._zip_file, item[0], item[1])
+
+
+# Extensions of files that are compressed already, deflating them again
+# costs time and rarely saves space.
+_COMPRESSED_EXTENSIONS = frozenset([
+    '.7z', '.aac', '.apk', '.br', '.bz2', '.gif', '.gz', '.hap', '.jar',
+    '.jpeg', '.jpg', '.lz4', '.mp3', '.mp4', '.ogg', '.png', '.tgz', '.webm',
+    '.webp', '.woff', '.woff2', '.xz', '.zip', '.zst'
+])
+
+
+def is_compressible(zip_path):
+    """compress_fn for do_zip()/zip_dir() that stores compressed files."""
+    return os.path.splitext(zip_path)[1].lower() not in _COMPRESSED_EXTENSIONS
+
+
 def add_to_zip_hermetic(zip_file,
                         zip_path,
                         src_path=None,
@@ -338,6 +629,8 @@ def add_to_zip_hermetic(zip_file,
                         compress=None):
     """Adds a file to the given ZipFile with a hard-coded modified time.
 
+    Files given by |src_path| are streamed into the zip in chunks.
+
     Args:
       zip_file: ZipFile instance to add the file to.
       zip_path: Destination path within the zip file.
@@ -365,14 +658,13 @@ def add_to_zip_hermetic(zip_file,
         for mode in (stat.S_IXUSR, stat.S_IXGRP, stat.S_IXOTH):
             if st.st_mode & mode:
                 zipinfo.external_attr |= mode << 16
-
-    if src_path:
-        with open(src_path, 'rb') as f:
-            data = f.read()
+        size = st.st_size
+    else:
+        size = len(data)
 
     # zipfile will deflate even when it makes the file bigger. To avoid
     # growing files, disable compression at an arbitrary cut off point.
-    if len(data) < 16:
+    if size < 16:
         compress = False
 
     # None converts to ZIP_STORED, when passed explicitly rather than the
@@ -380,23 +672,103 @@ def add_to_zip_hermetic(zip_file,
     compress_type = zip_file.compression
     if compress is not None:
         compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
-    zip_file.writestr(zipinfo, data, compress_type)
+    if data is not None:
+        zip_file.writestr(zipinfo, data, compress_type)
+        return
+
+    # same header and compressor writestr() would use
+    zipinfo.compress_type = compress_type
+    zipinfo._compresslevel = zip_file.compresslevel  # pylint: disable=protected-access
+    zipinfo.file_size = size
+    with open(src_path, 'rb') as infile, zip_file.open(zipinfo, 'w') as dest:
+        shutil.copyfileobj(infile, dest, _COPY_CHUNK_SIZE)
+
+
+def _read_and_close(infile):
+    with infile:
+        while True:
+            chunk = infile.read(_COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _hermetic_file_entry(zip_path, src_path, compress_type, compress_level):
+    """Returns (zipinfo, chunks) of |src_path| as add_to_zip_hermetic() has it.
+
+    Files of _STREAM_THRESHOLD bytes or more are deflated into a temporary
+    file rather than into memory.
+    """
+    if os.path.islink(src_path):
+        data = os.readlink(src_path).encode('utf-8')
+        return _hermetic_zipinfo(
+            zip_path, zipfile.ZIP_STORED, zlib.crc32(data), len(data),
+            len(data), _HERMETIC_FILE_ATTR | stat.S_IFLNK << 16), [data]
+
+    external_attr = _HERMETIC_FILE_ATTR
+    st = os.stat(src_path)
+    for mode in (stat.S_IXUSR, stat.S_IXGRP, stat.S_IXOTH):
+        if st.st_mode & mode:
+            external_attr |= mode << 16
+    if st.st_size < 16:
+        compress_type = zipfile.ZIP_STORED
+
+    if st.st_size < _STREAM_THRESHOLD:
+        with open(src_path, 'rb') as infile:
+            data = infile.read()
+        crc = zlib.crc32(data)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = _deflate(data, compress_level)
+        return _hermetic_zipinfo(zip_path, compress_type, crc, len(data),
+                                 st.st_size, external_attr), [data]
+
+    assert compress_type == zipfile.ZIP_DEFLATED
+    if compress_level is None:
+        compress_level = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    outfile = tempfile.TemporaryFile()
+    try:
+        with open(src_path, 'rb') as infile:
+            while True:
+                chunk = infile.read(_COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                outfile.write(compressor.compress(chunk))
+        outfile.write(compressor.flush())
+        compress_size = outfile.tell()
+        outfile.seek(0)
+    except BaseException:
+        outfile.close()
+        raise
+    return _hermetic_zipinfo(zip_path, compress_type, crc, compress_size,
+                             file_size,
+                             external_attr), _read_and_close(outfile)
 
 
 def do_zip(inputs,
            output,
            base_dir=None,
            compress_fn=None,
-           zip_prefix_path=None):
+           zip_prefix_path=None,
+           jobs=None):
     """Creates a zip file from a list of files.
 
+    Files are read and compressed on |jobs| threads, the output is the same
+    as adding them one by one with add_to_zip_hermetic().
+
     Args:
       inputs: A list of paths to zip, or a list of (zip_path, fs_path) tuples.
       output: Destination .zip file.
       base_dir: Prefix to strip from inputs.
       compress_fn: Applied to each input to determine whether or not to compress.
-          By default, items will be |zipfile.ZIP_STORED|.
+          By default, items will be |zipfile.ZIP_STORED|. is_compressible
+          compresses all but already compressed file types.
       zip_prefix_path: Path prepended to file path in zip file.
+      jobs: Number of threads, defaults to the number of CPUs.
     """
     input_tuples = []
     for tup in inputs:
@@ -406,18 +778,36 @@ def do_zip(inputs,
 
     # Sort by zip path to ensure stable zip ordering.
     input_tuples.sort(key=lambda tup: tup[0])
-    with zipfile.ZipFile(output, 'w') as outfile:
+    with zipfile.ZipFile(output, 'w') as outfile, \
+            _OrderedZipWriter(outfile, jobs or os.cpu_count() or 1) as writer:
         for zip_path, fs_path in input_tuples:
             if zip_prefix_path:
                 zip_path = os.path.join(zip_prefix_path, zip_path)
+            _check_zip_path(zip_path)
             compress = compress_fn(zip_path) if compress_fn else None
-            add_to_zip_hermetic(outfile,
-                                zip_path,
-                                src_path=fs_path,
-                                compress=compress)
+            compress_type = outfile.compression
+            if compress is not None:
+                compress_type = zipfile.ZIP_DEFLATED if compress \
+                    else zipfile.ZIP_STORED
+            size = os.lstat(fs_path).st_size
+            if size >= _STREAM_THRESHOLD and \
+                    compress_type == zipfile.ZIP_STORED and \
+                    not os.path.islink(fs_path):
+                # nothing to do ahead, stream it straight into the zip
+                writer.write_now(add_to_zip_hermetic,
+                                 zip_path,
+                                 src_path=fs_path,
+                                 compress=False)
+                continue
+            writer.add(min(size, _STREAM_THRESHOLD), _hermetic_file_entry,
+                       zip_path, fs_path, compress_type, outfile.compresslevel)
 
 
-def zip_dir(output, base_dir, compress_fn=None, zip_prefix_path=None):
+def zip_dir(output,
+            base_dir,
+            compress_fn=None,
+            zip_prefix_path=None,
+            jobs=None):
     """Creates a zip file from a directory."""
     inputs = []
     for root, _, files in os.walk(base_dir):
@@ -429,7 +819,8 @@ def zip_dir(output, base_dir, compress_fn=None, zip_prefix_path=None):
                f,
                base_dir,
                compress_fn=compress_fn,
-               zip_prefix_path=zip_prefix_path)
+               zip_prefix_path=zip_prefix_path,
+               jobs=jobs)
 
 
 def matches_glob(path, filters):
@@ -450,14 +841,103 @@ def _strip_dst_name(dst_name, options):
     return False
 
 
-def merge_zips(output, input_zips, path_transform=None, merge_args=None):
+def _read_raw_entry(raw_file, info, chunk_size=None):
+    """Yields the compressed bytes of |info| from the open zip |raw_file|."""
+    raw_file.seek(_entry_data_offset(raw_file.fileno(), info))
+    remain = info.compress_size
+    chunk_size = chunk_size or remain
+    while remain > 0:
+        chunk = raw_file.read(min(chunk_size, remain))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated entry %s' % info.filename)
+        remain -= len(chunk)
+        yield chunk
+
+
+def _can_copy_raw(info):
+    """Whether the compressed bytes of |info| can be reused as they are."""
+    if info.flag_bits & 0x1:
+        # encrypted
+        return False
+    if info.CRC == 0 and info.file_size:
+        # ijar writes null CRCs, those have to be computed
+        return False
+    if info.compress_type == zipfile.ZIP_STORED:
+        return True
+    # add_to_zip_hermetic() stores entries this small
+    return info.compress_type == zipfile.ZIP_DEFLATED and info.file_size >= 16
+
+
+def _compress_entry(zip_path, data):
+    if len(data) < 16:
+        return _hermetic_zipinfo(zip_path, zipfile.ZIP_STORED,
+                                 zlib.crc32(data), len(data),
+                                 len(data)), [data]
+    compressed = _deflate(data)
+    return _hermetic_zipinfo(zip_path, zipfile.ZIP_DEFLATED,
+                             zlib.crc32(data), len(compressed),
+                             len(data)), [compressed]
+
+
+def _merge_zip(writer, in_file, path_transform, options, added_names):
+    with zipfile.ZipFile(in_file, 'r') as in_zip, \
+            open(in_file, 'rb') as raw_file:
+        # ijar creates zips with null CRCs.
+        in_zip._expected_crc = None
+        for info in in_zip.infolist():
+            # Ignore directories.
+            if info.filename[-1] == '/':
+                continue
+            dst_name = path_transform(info.filename)
+            if not dst_name:
+                continue
+            if _strip_dst_name(dst_name, options):
+                continue
+            if dst_name in added_names:
+                continue
+            added_names.add(dst_name)
+            _check_zip_path(dst_name)
+            if _can_copy_raw(info):
+                zipinfo = _hermetic_zipinfo(dst_name, info.compress_type,
+                                            info.CRC, info.compress_size,
+                                            info.file_size)
+                if info.compress_size >= _STREAM_THRESHOLD:
+                    # stream big entries instead of buffering them
+                    writer.write_now(
+                        _write_compressed_entry, zipinfo,
+                        _read_raw_entry(raw_file, info, _COPY_CHUNK_SIZE))
+                else:
+                    writer.add_entry(info.compress_size, zipinfo,
+                                     list(_read_raw_entry(raw_file, info)))
+                continue
+            data = in_zip.read(info)
+            if info.compress_type == zipfile.ZIP_STORED:
+                writer.add_entry(
+                    len(data),
+                    _hermetic_zipinfo(dst_name, zipfile.ZIP_STORED,
+                                      zlib.crc32(data), len(data),
+                                      len(data)), [data])
+            else:
+                writer.add(len(data), _compress_entry, dst_name, data)
+
+
+def merge_zips(output,
+               input_zips,
+               path_transform=None,
+               merge_args=None,
+               jobs=None):
     """Combines all files from |input_zips| into |output|.
 
+    Stored entries and deflated entries with a valid CRC are copied without
+    recompressing them. Other entries are compressed on |jobs| threads and
+    written in input order, so the output does not depend on |jobs|.
+
     Args:
       output: Path or ZipFile instance to add files to.
       input_zips: Iterable of paths to zip files to merge.
       path_transform: Called for each entry path. Returns a new path, or None to
           skip the file.
+      jobs: Number of compression threads, defaults to the number of CPUs.
     """
     options = None
     if merge_args:
@@ -474,6 +954,7 @@ def merge_zips(output, input_zips, path_transform=None, merge_args=None):
 
     path_transform = path_transform or (lambda p: p)
     added_names = set()
+    jobs = jobs or os.cpu_count() or 1
 
     output_is_already_open = not isinstance(output, str)
     if output_is_already_open:
@@ -483,27 +964,10 @@ def merge_zips(output, input_zips, path_transform=None, merge_args=None):
         out_zip = zipfile.ZipFile(output, 'w')
 
     try:
-        for in_file in input_zips:
-            with zipfile.ZipFile(in_file, 'r') as in_zip:
-                # ijar creates zips with null CRCs.
-                in_zip._expected_crc = None
-                for info in in_zip.infolist():
-                    # Ignore directories.
-                    if info.filename[-1] == '/':
-                        continue
-                    dst_name = path_transform(info.filename)
-                    if not dst_name:
-                        continue
-                    if _strip_dst_name(dst_name, options):
-                        continue
-                    already_added = dst_name in added_names
-                    if not already_added:
-                        add_to_zip_hermetic(
-                            out_zip,
-                            dst_name,
-                            data=in_zip.read(info),
-                            compress=info.compress_type != zipfile.ZIP_STORED)
-                        added_names.add(dst_name)
+        with _OrderedZipWriter(out_zip, jobs) as writer:
+            for in_file in input_zips:
+                _merge_zip(writer, in_file, path_transform, options,
+                           added_names)
     finally:
         if not output_is_already_open:
             out_zip.close()
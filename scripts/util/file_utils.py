@@ -13,10 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import json
 import os
+import shutil
 import subprocess
-import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # pylint: disable=invalid-name
+
+_write_stats = {'written': 0, 'unchanged': 0}
+_write_stats_lock = threading.Lock()
+
+# FICLONE ioctl from linux/fs.h, shares the extents of another file.
+_FICLONE = 0x40049409
+
+LINK_MODES = ('copy', 'reflink', 'hardlink', 'auto')
 
 
 # Read json file data
@@ -55,46 +70,123 @@ def read_file(input_file):
     return data
 
 
+def _count_write(changed):
+    with _write_stats_lock:
+        if changed:
+            _write_stats['written'] += 1
+        else:
+            _write_stats['unchanged'] += 1
+
+
+# Number of files written and left untouched by this process
+def get_write_stats():
+    with _write_stats_lock:
+        return dict(_write_stats)
+
+
+# Write file data only if the bytes differ from the file on disk
+def write_file_if_changed(output_file, content):
+    if isinstance(content, str):
+        content = content.encode()
+    file_dir = os.path.dirname(os.path.abspath(output_file))
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir, exist_ok=True)
+
+    try:
+        with open(output_file, 'rb') as input_f:
+            changed = input_f.read() != content
+    except OSError:
+        changed = True
+    if changed:
+        with open(output_file, 'wb') as output_f:
+            output_f.write(content)
+    _count_write(changed)
+    return changed
+
+
 # Write json file data
 def write_json_file(output_file, content, check_changes=False):
+    json_content = json.dumps(content, sort_keys=True, indent=2)
+    if check_changes is True:
+        write_file_if_changed(output_file, json_content)
+        return
+
     file_dir = os.path.dirname(os.path.abspath(output_file))
     if not os.path.exists(file_dir):
         os.makedirs(file_dir, exist_ok=True)
+    with open(output_file, 'w') as output_f:
+        output_f.write(json_content)
+    _count_write(True)
 
-    if check_changes is True:
-        changed = __check_changes(output_file, content)
-    else:
-        changed = True
-    if changed is True:
-        with open(output_file, 'w') as output_f:
-            json.dump(content, output_f, sort_keys=True, indent=2)
-
-
-def __check_changes(output_file, content):
-    if os.path.exists(output_file) and os.path.isfile(output_file):
-        # file content md5 val
-        sha256_obj = hashlib.sha256()
-        sha256_obj.update(str(read_json_file(output_file)).encode())
-        hash_value = sha256_obj.hexdigest()
-        # new content md5 val
-        sha256_obj_new = hashlib.sha256()
-        sha256_obj_new.update(str(content).encode())
-        hash_value_new = sha256_obj_new.hexdigest()
-        if hash_value_new == hash_value:
-            return False
-    return True
+
+def _is_gn_file(output_file):
+    return output_file.endswith('.gni') or output_file.endswith('.gn')
 
 
 # Write file data
-def write_file(output_file, content):
+def write_file(output_file, content, check_changes=False):
+    if check_changes is True:
+        if _is_gn_file(output_file):
+            # Format in memory, so the comparison sees the final bytes.
+            cmd = ['gn', 'format', '--stdin']
+            content = subprocess.check_output(cmd, input=content.encode())
+        write_file_if_changed(output_file, content)
+        return
+
     file_dir = os.path.dirname(os.path.abspath(output_file))
     if not os.path.exists(file_dir):
         os.makedirs(file_dir, exist_ok=True)
 
     with open(output_file, 'w') as output_f:
         output_f.write(content)
-    if output_file.endswith('.gni') or output_file.endswith('.gn'):
+    if _is_gn_file(output_file):
         # Call gn format to make the output gn file prettier.
         cmd = ['gn', 'format']
         cmd.append(output_file)
         subprocess.check_output(cmd)
+    _count_write(True)
+
+
+def _reflink_file(source, dest):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+    with open(source, 'rb') as src_f:
+        dst_f = open(dest, 'wb')
+        try:
+            fcntl.ioctl(dst_f.fileno(), _FICLONE, src_f.fileno())
+        except OSError:
+            dst_f.close()
+            os.unlink(dest)
+            raise
+        dst_f.close()
+
+
+# Place the content of source at dest, sharing storage when possible.
+# link_mode 'hardlink' tries os.link first, 'reflink' and 'auto' try a
+# FICLONE reflink, and every mode falls back to a plain copy, e.g. across
+# filesystems. Returns the method used: 'hardlink', 'reflink' or 'copy'.
+def link_or_copy_file(source, dest, link_mode='auto'):
+    if link_mode not in LINK_MODES:
+        raise ValueError('unknown link mode: {}'.format(link_mode))
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    os.makedirs(dest_dir, exist_ok=True)
+    # Never write through an existing file, it may be a hardlink.
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    if link_mode == 'hardlink':
+        try:
+            os.link(source, dest)
+            return 'hardlink'
+        except OSError:
+            pass
+    if link_mode != 'copy':
+        try:
+            _reflink_file(source, dest)
+            shutil.copymode(source, dest)
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+    shutil.copymode(source, dest)
+    return 'copy'
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared file hashing helpers for build actions."""
+
+import argparse
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import xxhash  # pylint: disable=import-error
+except ImportError:
+    xxhash = None  # pylint: disable=invalid-name
+
+# Files at least this large are hashed through mmap, smaller ones are read
+# into a reused buffer.
+_MMAP_THRESHOLD = 4 * 1024 * 1024
+_BUFFER_SIZE = 1024 * 1024
+
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    FAST_ALGORITHM = 'xxh3_128'
+else:
+    FAST_ALGORITHM = 'blake2b'
+
+
+def new_hasher(algorithm=FAST_ALGORITHM):
+    """Returns a hash object for |algorithm|.
+
+    Besides the hashlib names, 'blake2b' is a 128 bit BLAKE2b and
+    'xxh3_128' needs the optional xxhash module.
+    """
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
+
+
+def update_from_file(hasher, path):
+    """Feeds the contents of |path| into |hasher|."""
+    with open(path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size >= _MMAP_THRESHOLD:
+            try:
+                with mmap.mmap(infile.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapped:
+                    hasher.update(mapped)
+                return
+            except (OSError, ValueError):
+                # not mappable (e.g. a special file), read it instead
+                pass
+        buf = bytearray(_BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            count = infile.readinto(buf)
+            if not count:
+                break
+            hasher.update(view[:count])
+
+
+def file_digest(path, algorithm=FAST_ALGORITHM):
+    """Returns the hex digest of the contents of |path|."""
+    hasher = new_hasher(algorithm)
+    update_from_file(hasher, path)
+    return hasher.hexdigest()
+
+
+def _make_synthetic_tree(root, total_size, file_size):
+    chunk = os.urandom(min(file_size, _BUFFER_SIZE))
+    paths = []
+    written = 0
+    while written < total_size:
+        sub_dir = os.path.join(root, 'd{}'.format(len(paths) // 64))
+        os.makedirs(sub_dir, exist_ok=True)
+        path = os.path.join(sub_dir, 'f{}'.format(len(paths)))
+        size = min(file_size, total_size - written)
+        with open(path, 'wb') as outfile:
+            remain = size
+            while remain > 0:
+                outfile.write(chunk[:remain])
+                remain -= len(chunk)
+        paths.append(path)
+        written += size
+    return paths
+
+
+def _legacy_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as infile:
+        while True:
+            data = infile.read(64 * 1024)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def _time_hashing(paths, digest_fn):
+    start = time.time()
+    for path in paths:
+        digest_fn(path)
+    return time.time() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='hash a synthetic tree with md5 and with the fast digest')
+    parser.add_argument('--size-mb', type=int, default=2048)
+    parser.add_argument('--file-size-mb', type=int, default=8)
+    parser.add_argument('--tmp-dir')
+    args = parser.parse_args(argv)
+
+    total_size = args.size_mb * 1024 * 1024
+    root = tempfile.mkdtemp(prefix='hash_bench_', dir=args.tmp_dir)
+    try:
+        paths = _make_synthetic_tree(root, total_size,
+                                     args.file_size_mb * 1024 * 1024)
+        # warm the page cache so both runs measure hashing, not disk
+        _time_hashing(paths, _legacy_md5)
+        results = [('md5', _time_hashing(paths, _legacy_md5)),
+                   (FAST_ALGORITHM, _time_hashing(paths, file_digest))]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    for name, seconds in results:
+        print('{:<10} {:8.2f}s {:8.1f} MB/s'.format(
+            name, seconds, args.size_mb / max(seconds, 1e-6)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Manifest of an installed image tree, read by the packagers.
+
+The manifest lists every file and symlink below an install root with its
+type, mode, size, mtime and link target, so packagers can archive the
+installed tree in place instead of unpacking the image zip:
+
+  {
+    "version": 1,
+    "root": "system",  # relative to the manifest file
+    "files": [
+      {"path": "bin/init", "type": "file", "mode": 493, "size": 1234,
+       "mtime_ns": 1600000000000000000},
+      {"path": "lib/libc.so.1", "type": "symlink", "target": "libc.so"}
+    ]
+  }
+
+Files are sorted by path components, which is the order tarfile walks a
+directory in.
+"""
+
+import json
+import os
+import stat
+
+from . import file_utils
+
+MANIFEST_VERSION = 1
+
+
+def _sort_key(path):
+    return path.split('/')
+
+
+def collect_installed_files(root_dir):
+    """Returns the manifest entries of the files below |root_dir|."""
+    entries = []
+    for root, dirs, files in os.walk(root_dir):
+        # os.walk() doesn't descend into symlinked directories, list them
+        names = files + [
+            name for name in dirs if os.path.islink(os.path.join(root, name))
+        ]
+        for name in names:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, root_dir).replace(os.sep, '/')
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries.append({
+                    'path': rel_path,
+                    'type': 'symlink',
+                    'target': os.readlink(path)
+                })
+            else:
+                entries.append({
+                    'path': rel_path,
+                    'type': 'file',
+                    'mode': stat.S_IMODE(st.st_mode),
+                    'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns
+                })
+    entries.sort(key=lambda entry: _sort_key(entry['path']))
+    return entries
+
+
+def write_manifest(manifest_file, root_dir):
+    """Writes the manifest of the files below |root_dir|."""
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'root': os.path.relpath(os.path.abspath(root_dir), manifest_dir),
+        'files': collect_installed_files(root_dir)
+    }
+    file_utils.write_json_file(manifest_file, manifest)
+
+
+def read_manifest(manifest_file):
+    """Returns (root dir, entries) of |manifest_file|."""
+    with open(manifest_file, 'r') as input_f:
+        manifest = json.load(input_f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise Exception('unsupported installed files manifest {}'.format(
+            manifest_file))
+    root_dir = os.path.join(os.path.dirname(os.path.abspath(manifest_file)),
+                            manifest['root'])
+    return os.path.normpath(root_dir), manifest['files']
+
+
+def directories_of(paths):
+    """Returns the parent directories of the '/' separated |paths|."""
+    dirs = set()
+    for path in paths:
+        parent = path.rpartition('/')[0]
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = parent.rpartition('/')[0]
+    return dirs
+
+
+def sorted_paths(paths):
+    return sorted(paths, key=_sort_key)
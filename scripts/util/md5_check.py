@@ -9,7 +9,10 @@ import hashlib
 import itertools
 import json
 import os
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from . import hash_utils
 from .pycache import pycache_enabled
 from .pycache import pycache
 
@@ -19,20 +22,87 @@ PRINT_EXPLANATIONS = int(os.environ.get('PRINT_BUILD_EXPLANATIONS', 0))
 # An escape hatch that causes all targets to be rebuilt.
 _FORCE_REBUILD = int(os.environ.get('FORCE_REBUILD', 0))
 
+# When set, input files are always re-hashed instead of trusting an
+# unchanged (size, mtime, inode) from the previous record.
+_FULL_HASH = int(os.environ.get('MD5_CHECK_FULL_HASH', 0))
 
-def get_new_metadata(input_strings, input_paths):
+# Files modified this close to the start of the action don't get a stat
+# record, a later write within the same mtime granularity could go unseen.
+_RACY_LIMIT_NS = time.time_ns() - 2 * 1000 * 1000 * 1000
+
+# Threads used to hash input paths, 1 hashes them serially.
+_JOBS = int(os.environ.get('MD5_CHECK_JOBS', min(8, os.cpu_count() or 1)))
+
+# Actions with few inputs are not worth starting a thread pool for.
+_MIN_PATHS_PER_JOB = 16
+
+# Bump when the record layout or the meaning of tags changes, records of
+# another version are treated as missing.
+_RECORD_VERSION = 2
+
+
+def get_new_metadata(input_strings, input_paths, old_metadata=None,
+                     jobs=None):
+    """Computes metadata of the inputs.
+
+    Args:
+      input_strings: List of strings to record verbatim.
+      input_paths: List of paths to calculate a md5 sum on.
+      old_metadata: Previous _Metadata, paths whose stat record is unchanged
+        reuse its tags instead of being hashed again.
+      jobs: Number of threads hashing files and reading zip directories,
+        defaults to MD5_CHECK_JOBS. The result does not depend on it.
+
+    File tags are hash_utils.FAST_ALGORITHM digests, the aggregate
+    strings/files md5 keep their names for compatibility.
+    """
     new_metadata = _Metadata()
     new_metadata.add_strings(input_strings)
 
-    for path in input_paths:
-        if _is_zip_file(path):
-            entries = _extract_zip_entries(path)
-            new_metadata.add_zip_file(path, entries)
+    if jobs is None:
+        jobs = _JOBS
+    jobs = min(jobs, len(input_paths) // _MIN_PATHS_PER_JOB)
+
+    def path_metadata(path):
+        return _metadata_for_path(path, old_metadata)
+
+    if jobs > 1:
+        # hashlib and zlib release the GIL on large buffers, threads are
+        # enough. map() keeps the results in input order.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(path_metadata, input_paths))
+    else:
+        results = map(path_metadata, input_paths)
+
+    for path, is_zip, value, path_stat in results:
+        if is_zip:
+            new_metadata.add_zip_file(path, value, path_stat)
         else:
-            new_metadata.add_file(path, _md5_for_path(path))
+            new_metadata.add_file(path, value, path_stat)
     return new_metadata
 
 
+def _metadata_for_path(path, old_metadata):
+    """Returns (path, is_zip, tag or zip entries, stat record) of path."""
+    path_stat = _stat_for_path(path)
+    old_entry = None
+    if old_metadata and path_stat is not None \
+            and old_metadata.get_stat(path) == path_stat:
+        old_entry = old_metadata.get_entry(path)
+    if _is_zip_file(path):
+        if old_entry:
+            entries = [(e['path'], e['tag'])
+                       for e in old_entry.get('entries', [])]
+        else:
+            entries = _extract_zip_entries(path)
+        return path, True, entries, path_stat
+    if old_entry:
+        tag = old_entry['tag']
+    else:
+        tag = _hash_for_path(path)
+    return path, False, tag, path_stat
+
+
 def get_old_metadata(record_path):
     old_metadata = None
     if os.path.exists(record_path):
@@ -67,6 +137,9 @@ def call_and_record_if_stale(
     - the contents of any file within input_paths has changed, or
     - the contents of input_strings has changed.
 
+    Input files whose size, mtime and inode match the previous record are
+    not hashed again, set MD5_CHECK_FULL_HASH=1 to always hash them.
+
     To debug which files are out-of-date, set the environment variable:
         PRINT_MD5_DIFFS=1
 
@@ -86,13 +159,15 @@ def call_and_record_if_stale(
     input_strings = input_strings or []
     output_paths = output_paths or []
 
-    new_metadata = get_new_metadata(input_strings, input_paths)
     force = force or _FORCE_REBUILD
     missing_outputs = [
         x for x in output_paths if force or not os.path.exists(x)
     ]
 
     if pycache_enabled:
+        start = time.time()
+        new_metadata = get_new_metadata(input_strings, input_paths)
+        pycache.add_timing('hash', time.time() - start)
         # Input strings, input files and outputs names together compose
         # cache manifest, which is the only identifier of a python action.
         manifest = '-'.join(
@@ -102,9 +177,13 @@ def call_and_record_if_stale(
         old_metadata = get_old_metadata(record_path)
     else:
         record_path = record_path or output_paths[0] + '.md5.stamp'
+        # The previous record lets unchanged input files skip hashing.
+        record_metadata = get_old_metadata(record_path)
+        new_metadata = get_new_metadata(input_strings, input_paths,
+                                        record_metadata)
         # When outputs are missing, don't bother gathering change information.
         if not missing_outputs:
-            old_metadata = get_old_metadata(record_path)
+            old_metadata = record_metadata
         else:
             old_metadata = None
 
@@ -117,18 +196,26 @@ def call_and_record_if_stale(
 
     print_explanations(record_path, changes)
 
+    if pycache_enabled:
+        # Outputs retrieved as hardlinks must not be rewritten in place.
+        pycache.detach(output_paths)
     args = (changes, ) if pass_changes else ()
+    start = time.time()
     function(*args)
     if pycache_enabled:
-        try:
-            pycache.report_cache_stat('cache_miss')
-        except:  # noqa: E722 pylint: disable=bare-except
-            pass
+        pycache.add_timing('run', time.time() - start)
         pycache.save(output_paths, prefix=manifest)
 
     with open(record_path, 'w') as record:
         new_metadata.to_file(record)
 
+    if pycache_enabled:
+        # Reported last, so the daemon can index the stored artifacts.
+        try:
+            pycache.report_cache_stat('cache_miss')
+        except:  # noqa: E722 pylint: disable=bare-except
+            pass
+
 
 class Changes(object):
     """Provides and API for querying what changed between runs."""
@@ -279,6 +366,9 @@ class _Metadata(object):
         """Returns a _Metadata initialized from a file object."""
         ret = cls()
         obj = json.load(fileobj)
+        if (obj.get('version') != _RECORD_VERSION or
+                obj.get('hash-algorithm') != hash_utils.FAST_ALGORITHM):
+            raise ValueError('Record of another format, ignore it.')
         ret._files_md5 = obj['files-md5']
         ret._strings_md5 = obj['strings-md5']
         ret._files = obj['input-files']
@@ -288,6 +378,8 @@ class _Metadata(object):
     def to_file(self, fileobj):
         """Serializes metadata to the given file object."""
         obj = {
+            "version": _RECORD_VERSION,
+            "hash-algorithm": hash_utils.FAST_ALGORITHM,
             "files-md5": self.files_md5(),
             "strings-md5": self.strings_md5(),
             "input-files": self._files,
@@ -304,30 +396,35 @@ class _Metadata(object):
         self._assert_not_queried()
         self._strings.extend(str(v) for v in values)
 
-    def add_file(self, path, tag):
+    def add_file(self, path, tag, stat=None):
         """Adds metadata for a non-zip file.
 
         Args:
           path: Path to the file.
           tag: A short string representative of the file contents.
+          stat: Optional stat record of the file, see _stat_for_path().
         """
         self._assert_not_queried()
-        self._files.append({
+        entry = {
             'path': path,
             'tag': tag,
-        })
+        }
+        if stat is not None:
+            entry['stat'] = stat
+        self._files.append(entry)
 
-    def add_zip_file(self, path, entries):
+    def add_zip_file(self, path, entries, stat=None):
         """Adds metadata for a zip file.
 
         Args:
           path: Path to the file.
           entries: List of (subpath, tag) tuples for entries within the zip.
+          stat: Optional stat record of the file, see _stat_for_path().
         """
         self._assert_not_queried()
         tag = _compute_inline_md5(
             itertools.chain((e[0] for e in entries), (e[1] for e in entries)))
-        self._files.append({
+        entry = {
             'path':
             path,
             'tag':
@@ -336,7 +433,10 @@ class _Metadata(object):
                 "path": e[0],
                 "tag": e[1]
             } for e in entries],
-        })
+        }
+        if stat is not None:
+            entry['stat'] = stat
+        self._files.append(entry)
 
     def get_strings(self):
         """Returns the list of input strings."""
@@ -372,6 +472,15 @@ class _Metadata(object):
         ret = self._get_entry(path, subpath)
         return ret and ret['tag']
 
+    def get_entry(self, path):
+        """Returns the JSON entry for the given top-level path."""
+        return self._get_entry(path)
+
+    def get_stat(self, path):
+        """Returns the recorded stat for the given top-level path."""
+        ret = self._get_entry(path)
+        return ret and ret.get('stat')
+
     def iter_paths(self):
         """Returns a generator for all top-level paths."""
         return (e['path'] for e in self._files)
@@ -389,35 +498,63 @@ class _Metadata(object):
         return (entry['path'] for entry in subentries)
 
 
-def _update_md5_for_file(md5, path, block_size=2**16):
-    # record md5 of linkto for dead link.
+def _update_hash_for_file(hasher, path):
+    # record hash of linkto for dead link.
     if os.path.islink(path):
         linkto = os.readlink(path)
         if not os.path.exists(linkto):
-            md5.update(linkto.encode())
+            hasher.update(linkto.encode())
             return
 
-    with open(path, 'rb') as infile:
-        while True:
-            data = infile.read(block_size)
-            if not data:
-                break
-            md5.update(data)
+    hash_utils.update_from_file(hasher, path)
 
 
-def _update_md5_for_directory(md5, dir_path):
+def _update_hash_for_directory(hasher, dir_path):
     for root, _, files in os.walk(dir_path):
         for f in files:
-            _update_md5_for_file(md5, os.path.join(root, f))
+            _update_hash_for_file(hasher, os.path.join(root, f))
 
 
-def _md5_for_path(path):
-    md5 = hashlib.md5()
+def _stat_for_file(path):
+    file_stat = os.stat(path)
+    if file_stat.st_mtime_ns >= _RACY_LIMIT_NS:
+        return None
+    return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+
+def _stat_for_path(path):
+    """Returns a json friendly stat record of path, or None.
+
+    Directories record every file in walk order, since a nested change
+    doesn't bump the directory mtime.
+    """
+    if _FULL_HASH:
+        return None
+    try:
+        if not os.path.isdir(path):
+            return _stat_for_file(path)
+        records = []
+        for root, _, files in os.walk(path):
+            for f in files:
+                file_path = os.path.join(root, f)
+                file_stat = _stat_for_file(file_path)
+                if file_stat is None:
+                    return None
+                records.append([os.path.relpath(file_path, path)] +
+                               file_stat)
+        return records
+    except OSError:
+        # dead links and the like are always hashed
+        return None
+
+
+def _hash_for_path(path):
+    hasher = hash_utils.new_hasher()
     if os.path.isdir(path):
-        _update_md5_for_directory(md5, path)
+        _update_hash_for_directory(hasher, path)
     else:
-        _update_md5_for_file(md5, path)
-    return md5.hexdigest()
+        _update_hash_for_file(hasher, path)
+    return hasher.hexdigest()
 
 
 def _compute_inline_md5(iterable):
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Multi-threaded gzip writer, laid out like pigz output.
+
+The input is cut into blocks that are deflated on a thread pool, each one
+primed with the last 32 KiB of the block before and ended with a sync
+flush. The compressed blocks are concatenated into one ordinary gzip
+member, so gzip, tar -xz and the gzip module read it as usual, and the
+output only depends on the data, the level and the block size.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import io
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import zlib
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+_DICT_SIZE = 32 * 1024
+# raw deflate of an empty final block
+_FINAL_BLOCK = b'\x03\x00'
+
+
+def _deflate_block(data, zdict, level):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Writable file object that gzips to |fileobj| on |jobs| threads.
+
+    Args:
+      fileobj: Binary file object the gzip stream is written to.
+      level: Compression level, 1 to 9.
+      mtime: Modification time recorded in the gzip header, 0 for none.
+      jobs: Number of compression threads, the number of CPUs by default.
+      block_size: Bytes of input deflated per task.
+    """
+
+    def __init__(self,
+                 fileobj,
+                 level=6,
+                 mtime=0,
+                 jobs=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        super(ParallelGzipWriter, self).__init__()
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._jobs = jobs or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._crc = 0
+        self._size = 0
+        if level == 9:
+            extra_flags = 2
+        elif level == 1:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+        # magic, deflate, no flags, mtime, extra flags, unknown OS
+        fileobj.write(
+            struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, int(mtime),
+                        extra_flags, 255))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        data = memoryview(data).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_deflate_block, block, self._zdict,
+                                  self._level))
+        self._zdict = block[-_DICT_SIZE:]
+        # keep a few blocks per thread in flight, not the whole input
+        while len(self._pending) > 2 * self._jobs:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            self._fileobj.write(_FINAL_BLOCK)
+            self._fileobj.write(
+                struct.pack('<LL', self._crc, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            super(ParallelGzipWriter, self).close()
+
+
+def _make_synthetic_tree(root, total_size, file_size):
+    # half random, half repeated text, roughly as compressible as binaries
+    text = b''.join(b'symbol_%d libfoo.so.%d\n' % (i, i % 7)
+                    for i in range(4096))
+    paths = []
+    written = 0
+    while written < total_size:
+        sub_dir = os.path.join(root, 'd{}'.format(len(paths) // 64))
+        os.makedirs(sub_dir, exist_ok=True)
+        path = os.path.join(sub_dir, 'f{}'.format(len(paths)))
+        size = min(file_size, total_size - written)
+        with open(path, 'wb') as outfile:
+            remain = size
+            while remain > 0:
+                chunk = os.urandom(min(remain, len(text)) // 2) + text
+                outfile.write(chunk[:remain])
+                remain -= len(chunk)
+        paths.append(path)
+        written += size
+    return paths
+
+
+def _tar_serial(tree, output, level, jobs):
+    with tarfile.open(output, 'w:gz', compresslevel=level) as tar:
+        tar.add(tree, arcname='system')
+
+
+def _tar_parallel(tree, output, level, jobs):
+    with open(output, 'wb') as outfile, \
+            ParallelGzipWriter(outfile, level, jobs=jobs) as gz_file, \
+            tarfile.open(fileobj=gz_file, mode='w') as tar:
+        tar.add(tree, arcname='system')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='tar.gz a synthetic tree with tarfile and in parallel')
+    parser.add_argument('--size-mb', type=int, default=2048)
+    parser.add_argument('--file-size-mb', type=int, default=8)
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--jobs', type=int)
+    parser.add_argument('--tmp-dir')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='gzip_bench_', dir=args.tmp_dir)
+    results = []
+    try:
+        tree = os.path.join(root, 'tree')
+        _make_synthetic_tree(tree, args.size_mb * 1024 * 1024,
+                             args.file_size_mb * 1024 * 1024)
+        output = os.path.join(root, 'out.tar.gz')
+        for name, tar_fn in (('tarfile w:gz', _tar_serial),
+                             ('parallel', _tar_parallel)):
+            start = time.time()
+            tar_fn(tree, output, args.level, args.jobs)
+            results.append(
+                (name, time.time() - start, os.path.getsize(output)))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    for name, seconds, size in results:
+        print('{:<14} {:8.2f}s {:8.1f} MB/s {:8.1f} MB'.format(
+            name, seconds, args.size_mb / max(seconds, 1e-6),
+            size / 1024.0 / 1024.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -13,28 +13,191 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import shutil
 import os
 import hashlib
 import json
-import http.client as client
+import socket
+import stat
+import sys
+import time
 from . import build_utils
+from . import file_utils
+from . import hash_utils
+
+# Bump when the layout of '.file'/'.tree' index files changes, pyd.py
+# reads them to find the blobs that are still referenced.
+_INDEX_VERSION = 2
 
 
 class Storage():
-    def __init__(self):
-        pass
+    """Content addressed cache artifact store.
+
+    Output bytes live once in <pycache_dir>/blobs, named by their digest.
+    A file output is stored as a '.file' index naming its blob, a
+    directory output as a '.tree' index listing the blobs of its files,
+    so identical outputs of different actions share storage and
+    retrieving an output only links the blobs back.
+    PYCACHE_LINK_MODE picks how files are placed, see
+    file_utils.link_or_copy_file. With 'hardlink', outputs share inodes
+    with the cache, and call detach_object before rewriting them.
+    """
+    def __init__(self, pycache_dir=None):
+        self.blob_dir = os.path.join(pycache_dir or '', 'blobs')
+        self.link_mode = os.environ.get('PYCACHE_LINK_MODE', 'auto')
+        # Output bytes restored from and written to the cache.
+        self.retrieved_bytes = 0
+        self.stored_bytes = 0
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:])
+
+    def _place(self, source, dest):
+        method = file_utils.link_or_copy_file(source, dest, self.link_mode)
+        if pycache_debug_enable:
+            print('{} {} to {}'.format(method, source, dest))
 
     @classmethod
-    def retrieve_object(cls, cache_artifact, obj):
+    def _touch_atime(cls, path):
+        # Only atime, a blob may share its inode with a build output whose
+        # mtime must stay put.
+        stat_result = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat_result.st_mtime_ns))
+
+    def _add_blob(self, path):
+        digest = hash_utils.file_digest(path)
+        stat_result = os.stat(path)
+        mode = stat.S_IMODE(stat_result.st_mode)
+        blob = self._blob_path(digest)
+        if os.path.exists(blob):
+            # Tells the daemon's eviction the blob is in use again.
+            self._touch_atime(blob)
+        else:
+            # Concurrent actions may store the same blob, publish it
+            # atomically.
+            tmp_blob = '{}.{}.tmp'.format(blob, os.getpid())
+            self._place(path, tmp_blob)
+            os.replace(tmp_blob, blob)
+        self.stored_bytes += stat_result.st_size
+        return digest, mode, stat_result.st_size
+
+    @classmethod
+    def _write_index(cls, index_artifact, index):
+        index['version'] = _INDEX_VERSION
+        tmp_artifact = '{}.{}.tmp'.format(index_artifact, os.getpid())
+        with open(tmp_artifact, 'w') as jsonfile:
+            json.dump(index, jsonfile, sort_keys=True)
+        os.replace(tmp_artifact, index_artifact)
+
+    @classmethod
+    def _read_index(cls, index_artifact):
+        with open(index_artifact, 'r') as jsonfile:
+            index = json.load(jsonfile)
+        if index.get('version') != _INDEX_VERSION:
+            return None
+        return index
+
+    def _place_blob(self, digest, mode, size, path):
+        blob = self._blob_path(digest)
+        self._place(blob, path)
+        if stat.S_IMODE(os.stat(path).st_mode) != mode:
+            if os.stat(path).st_nlink > 1:
+                # A hardlink can't have its own mode, copy instead.
+                file_utils.link_or_copy_file(blob, path, 'copy')
+            os.chmod(path, mode)
+        self._touch_atime(blob)
+        self.retrieved_bytes += size
+
+    def _add_file(self, file_artifact, path):
+        digest, mode, size = self._add_blob(path)
+        self._write_index(file_artifact, {
+            'digest': digest,
+            'mode': mode,
+            'size': size
+        })
+
+    def _retrieve_file(self, file_artifact, path):
+        index = self._read_index(file_artifact)
+        if index is None \
+                or not os.path.exists(self._blob_path(index['digest'])):
+            return 0
+        self._place_blob(index['digest'], index['mode'], index['size'],
+                         path)
+        return 1
+
+    def _add_tree(self, tree_artifact, dir_path):
+        tree = {'dirs': [], 'files': [], 'symlinks': []}
+        for root, dirs, files in os.walk(dir_path):
+            rel_root = os.path.relpath(root, dir_path)
+            for name in sorted(dirs):
+                path = os.path.join(root, name)
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+                if os.path.islink(path):
+                    tree['symlinks'].append([rel_path, os.readlink(path)])
+                else:
+                    tree['dirs'].append(rel_path)
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+                if os.path.islink(path):
+                    tree['symlinks'].append([rel_path, os.readlink(path)])
+                    continue
+                digest, mode, size = self._add_blob(path)
+                tree['files'].append([rel_path, digest, mode, size])
+        self._write_index(tree_artifact, tree)
+
+    def _retrieve_tree(self, tree_artifact, dir_path):
+        tree = self._read_index(tree_artifact)
+        if tree is None:
+            return 0
+        # A blob may have been evicted, check before touching the output.
+        for _, digest, _, _ in tree['files']:
+            if not os.path.exists(self._blob_path(digest)):
+                return 0
+        os.makedirs(dir_path, exist_ok=True)
+        for rel_path in tree['dirs']:
+            os.makedirs(os.path.join(dir_path, rel_path), exist_ok=True)
+        for rel_path, digest, mode, size in tree['files']:
+            self._place_blob(digest, mode, size,
+                             os.path.join(dir_path, rel_path))
+        for rel_path, target in tree['symlinks']:
+            path = os.path.join(dir_path, rel_path)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(target, path)
+        return 1
+
+    def retrieve_object(self, cache_artifact, obj):
+        """Restores obj, returns the artifact used or 0 on a miss."""
+        file_artifact = '{}.file'.format(cache_artifact)
+        tree_artifact = '{}.tree'.format(cache_artifact)
         possible_dir_cache_artifact = '{}.directory'.format(cache_artifact)
 
-        if os.path.exists(cache_artifact):
-            os.makedirs(os.path.dirname(obj), exist_ok=True)
-            shutil.copyfile(cache_artifact, obj)
-            os.utime(cache_artifact)
+        if os.path.exists(file_artifact):
+            if not self._retrieve_file(file_artifact, obj):
+                if pycache_debug_enable:
+                    print('Failed to retrieve {} from cache'.format(obj))
+                return 0
+            os.utime(file_artifact)
+            if pycache_debug_enable:
+                print('Retrieve {} from cache'.format(obj))
+            return file_artifact
+        elif os.path.exists(cache_artifact):
+            # Plain copy stored by an older pycache.
+            self._place(cache_artifact, obj)
+            self._touch_atime(cache_artifact)
+            self.retrieved_bytes += os.path.getsize(obj)
             if pycache_debug_enable:
                 print('Retrieve {} from cache'.format(obj))
+            return cache_artifact
+        elif os.path.exists(tree_artifact):
+            if not self._retrieve_tree(tree_artifact, obj):
+                if pycache_debug_enable:
+                    print('Failed to retrieve {} from cache'.format(obj))
+                return 0
+            os.utime(tree_artifact)
+            if pycache_debug_enable:
+                print('Link {} from cache'.format(obj))
+            return tree_artifact
         elif os.path.exists(possible_dir_cache_artifact):
             # Extract zip archive if it's cache artifact for directory.
             os.makedirs(obj, exist_ok=True)
@@ -44,29 +207,46 @@ class Storage():
             os.utime(possible_dir_cache_artifact)
             if pycache_debug_enable:
                 print('Extract {} from cache'.format(obj))
-        else:
-            if pycache_debug_enable:
-                print('Failed to retrieve {} from cache'.format(obj))
-            return 0
-        return 1
+            return possible_dir_cache_artifact
+        if pycache_debug_enable:
+            print('Failed to retrieve {} from cache'.format(obj))
+        return 0
 
-    @classmethod
-    def add_object(cls, cache_artifact, obj):
+    def add_object(self, cache_artifact, obj):
+        """Stores obj, returns the artifact written or None."""
         cache_dir = os.path.dirname(cache_artifact)
         os.makedirs(cache_dir, exist_ok=True)
 
         if not os.path.exists(obj):
-            return
-        # If path is directory, store an zip archive.
+            return None
+        # If path is directory, store a manifest of its blobs.
         if os.path.isdir(obj):
-            dir_cache_artifact = '{}.directory'.format(cache_artifact)
-            build_utils.zip_dir(dir_cache_artifact, obj)
+            tree_artifact = '{}.tree'.format(cache_artifact)
+            self._add_tree(tree_artifact, obj)
             if pycache_debug_enable:
-                print("archive {} to {}".format(obj, dir_cache_artifact))
+                print("archive {} to {}".format(obj, tree_artifact))
+            return tree_artifact
         else:
-            shutil.copyfile(obj, cache_artifact)
+            file_artifact = '{}.file'.format(cache_artifact)
+            self._add_file(file_artifact, obj)
             if pycache_debug_enable:
-                print("copying {} to {}".format(obj, cache_artifact))
+                print("store {} as {}".format(obj, file_artifact))
+            return file_artifact
+
+    def detach_object(self, obj):
+        """Gives obj private inodes, so rewriting it leaves the cache alone."""
+        if self.link_mode != 'hardlink' or not os.path.exists(obj):
+            return
+        if os.path.isdir(obj):
+            paths = build_utils.get_all_files(obj)
+        else:
+            paths = [obj]
+        for path in paths:
+            if os.path.islink(path) or os.stat(path).st_nlink < 2:
+                continue
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            file_utils.link_or_copy_file(path, tmp_path, 'copy')
+            os.replace(tmp_path, path)
 
 
 class PyCache():
@@ -76,15 +256,31 @@ class PyCache():
             self.pycache_dir = cache_dir
         else:
             raise Exception('Error: failed to get PYCACHE_DIR')
-        self.storage = Storage()
+        self.storage = Storage(self.pycache_dir)
+        # Artifacts read or written since the last report to the daemon.
+        self.accessed_artifacts = []
+        self.manifest_path = None
+        # Seconds spent hashing inputs, running the action and reading or
+        # writing the cache, reported with the next event.
+        self.timings = {'hash': 0.0, 'run': 0.0, 'cache': 0.0}
+        self.stats_socket = None
+
+    def add_timing(self, name, seconds):
+        self.timings[name] += seconds
 
     def retrieve(self, output_paths, prefix=''):
+        start = time.time()
+        artifacts = []
         for path in output_paths:
             _, cache_artifact = self.descend_directory('{}{}'.format(
                 prefix, path))
             result = self.storage.retrieve_object(cache_artifact, path)
             if not result:
+                self.add_timing('cache', time.time() - start)
                 return result
+            artifacts.append(result)
+        self.accessed_artifacts.extend(artifacts)
+        self.add_timing('cache', time.time() - start)
 
         try:
             self.report_cache_stat('cache_hit')
@@ -93,24 +289,69 @@ class PyCache():
         return 1
 
     def save(self, output_paths, prefix=''):
+        start = time.time()
         for path in output_paths:
             _, cache_artifact = self.descend_directory('{}{}'.format(
                 prefix, path))
-            self.storage.add_object(cache_artifact, path)
+            artifact = self.storage.add_object(cache_artifact, path)
+            if artifact:
+                self.accessed_artifacts.append(artifact)
+        self.add_timing('cache', time.time() - start)
+
+    def detach(self, output_paths):
+        for path in output_paths:
+            self.storage.detach_object(path)
 
     def report_cache_stat(self, hit_or_miss):
-        pyd_server, pyd_port = self.get_pyd()
-        conn = client.HTTPConnection(pyd_server, pyd_port)
-        conn.request(hit_or_miss, '/')
-        conn.close()
+        """Sends a hit/miss event to the daemon without waiting for it.
 
-    def get_pyd(self):
+        The daemon indexes the reported artifacts for eviction. An event
+        the daemon can't take right now is dropped.
+        """
+        if hit_or_miss == 'cache_hit':
+            output_bytes = self.storage.retrieved_bytes
+        else:
+            output_bytes = self.storage.stored_bytes
+        event = {
+            'event': hit_or_miss,
+            'action': os.path.basename(sys.argv[0]),
+            'bytes': output_bytes,
+            'artifacts': [
+                os.path.relpath(path, self.pycache_dir)
+                for path in self.accessed_artifacts
+            ],
+            'hash_seconds': self.timings['hash'],
+            'run_seconds': self.timings['run'],
+            'cache_seconds': self.timings['cache'],
+        }
+        if self.manifest_path:
+            event['manifest'] = os.path.relpath(self.manifest_path,
+                                                self.pycache_dir)
+        self.accessed_artifacts = []
+        self.manifest_path = None
+        self.timings = dict.fromkeys(self.timings, 0.0)
+        self.storage.retrieved_bytes = 0
+        self.storage.stored_bytes = 0
+
+        if self.stats_socket is None:
+            self.stats_socket = self.get_pyd_config().get('stats_socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto(json.dumps(event).encode(), self.stats_socket)
+        finally:
+            sock.close()
+
+    def get_pyd_config(self):
         daemon_config_file = '{}/.config'.format(self.pycache_dir)
         if not os.path.exists(daemon_config_file):
             raise Exception('Warning: no pycache daemon process exists.')
         with open(daemon_config_file, 'r') as jsonfile:
-            data = json.load(jsonfile)
-            return data.get('host'), data.get('port')
+            return json.load(jsonfile)
+
+    def get_pyd(self):
+        data = self.get_pyd_config()
+        return data.get('host'), data.get('port')
 
     @classmethod
     def cache_key(cls, path):
@@ -127,6 +368,8 @@ class PyCache():
     def get_manifest_path(self, path):
         manifest_dir, manifest_file = self.descend_directory(path)
         os.makedirs(manifest_dir, exist_ok=True)
+        self.accessed_artifacts.append(manifest_file)
+        self.manifest_path = manifest_file
         return manifest_file
 
 
@@ -18,7 +18,12 @@ import sys
 import argparse
 import errno
 import json
-import datetime
+import select
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import http.client as client
 
 from http.server import BaseHTTPRequestHandler
@@ -29,6 +34,305 @@ LOCALHOST = '127.0.0.1'
 DEBUG = int(os.environ.get('PRINT_BUILD_EXPLANATIONS', 0))
 
 
+# Index files written by pycache.Storage, they name the blobs an output is
+# made of. Keep in sync with pycache._INDEX_VERSION.
+_INDEX_SUFFIXES = ('.file', '.tree')
+_INDEX_VERSION = 2
+
+# Blobs are stored before the index naming them, and an existing blob is
+# touched when another output reuses it. Recently used ones are spared.
+_BLOB_GRACE_SECONDS = 3600
+
+# A full walk of the cache catches files no client reported.
+_RECONCILE_SECONDS = 7 * 24 * 3600
+
+_EVICT_BATCH = 1000
+
+# sun_path of a unix socket holds 108 bytes including the terminator.
+_MAX_SOCKET_PATH = 104
+_MAX_STATS_EVENT = 256 * 1024
+_STATS_RCVBUF = 4 * 1024 * 1024
+_STATS_POLL_SECONDS = 0.5
+
+# Per-action telemetry, summed over hit and miss events.
+_ACTION_COLUMNS = ('hits', 'misses', 'bytes_restored', 'hash_seconds',
+                   'cache_seconds', 'run_seconds', 'saved_seconds')
+
+
+def _index_blob_sizes(path):
+    """Returns [(digest, size)] referenced by index file path, or None."""
+    if not path.endswith(_INDEX_SUFFIXES):
+        return None
+    try:
+        with open(path, 'r') as jsonfile:
+            index = json.load(jsonfile)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != _INDEX_VERSION:
+        # unknown layout, its blobs are left to eviction
+        return []
+    if 'digest' in index:
+        return [(index['digest'], index['size'])]
+    return [(digest, size) for _, digest, _, size in index.get('files', [])]
+
+
+class CacheIndex(object):
+    """SQLite index of cache artifacts, their size and last access.
+
+    Artifacts are every file outside blobs/, keyed by their path relative
+    to the cache root. Blobs have no access time of their own, they live
+    as long as an artifact refers to them.
+    """
+    def __init__(self, pycache_dir):
+        self.pycache_dir = pycache_dir
+        self.blob_dir = os.path.join(pycache_dir, 'blobs')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(pycache_dir, '.index.db'),
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    path TEXT PRIMARY KEY, size INTEGER, atime REAL);
+                CREATE INDEX IF NOT EXISTS artifacts_atime
+                    ON artifacts (atime);
+                CREATE TABLE IF NOT EXISTS refs (
+                    path TEXT, digest TEXT, size INTEGER);
+                CREATE INDEX IF NOT EXISTS refs_path ON refs (path);
+                CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest);
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY, size INTEGER);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value REAL);
+                CREATE TABLE IF NOT EXISTS run_times (
+                    manifest TEXT PRIMARY KEY, seconds REAL);
+                CREATE TABLE IF NOT EXISTS action_stats (
+                    action TEXT PRIMARY KEY, hits INTEGER, misses INTEGER,
+                    bytes_restored INTEGER, hash_seconds REAL,
+                    cache_seconds REAL, run_seconds REAL,
+                    saved_seconds REAL);
+            ''')
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:])
+
+    def _set_refs(self, rel_path, sizes):
+        self._db.execute('DELETE FROM refs WHERE path = ?', (rel_path, ))
+        self._db.executemany(
+            'INSERT INTO refs (path, digest, size) VALUES (?, ?, ?)',
+            [(rel_path, digest, size) for digest, size in sizes])
+        self._db.executemany(
+            'INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)',
+            sizes)
+
+    def record_access(self, accesses):
+        """Marks artifacts as used now, stored ones get their refs reread.
+
+        accesses is a list of (relative paths, stored) of several events,
+        recorded in one transaction.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            for rel_path, stored in [(rel_path, stored)
+                                     for rel_paths, stored in accesses
+                                     for rel_path in rel_paths]:
+                path = os.path.join(self.pycache_dir, rel_path)
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue
+                known = self._db.execute(
+                    'SELECT 1 FROM artifacts WHERE path = ?',
+                    (rel_path, )).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO artifacts (path, size, atime) '
+                    'VALUES (?, ?, ?)', (rel_path, size, now))
+                if stored or not known:
+                    sizes = _index_blob_sizes(path)
+                    if sizes is not None:
+                        self._set_refs(rel_path, sizes)
+
+    def record_telemetry(self, events):
+        """Adds events to the per-action totals.
+
+        A miss remembers how long its manifest took to run, a later hit
+        of that manifest saved that time minus hashing and retrieving.
+        The hashing and storing of a miss count as time lost. Returns
+        the totals of this batch, {action: {column: value}}.
+        """
+        totals = {}
+        with self._lock, self._db:
+            for event in events:
+                is_hit = event.get('event') == 'cache_hit'
+                manifest = event.get('manifest')
+                overhead = event.get('hash_seconds', 0.0) + event.get(
+                    'cache_seconds', 0.0)
+                if is_hit:
+                    row = self._db.execute(
+                        'SELECT seconds FROM run_times WHERE manifest = ?',
+                        (manifest, )).fetchone()
+                    # Unknown when the miss predates the telemetry.
+                    saved = row[0] - overhead if row else 0.0
+                else:
+                    if manifest:
+                        self._db.execute(
+                            'INSERT OR REPLACE INTO run_times VALUES (?, ?)',
+                            (manifest, event.get('run_seconds', 0.0)))
+                    saved = -overhead
+                row = (1 if is_hit else 0, 0 if is_hit else 1,
+                       event.get('bytes', 0) if is_hit else 0,
+                       event.get('hash_seconds', 0.0),
+                       event.get('cache_seconds', 0.0),
+                       event.get('run_seconds', 0.0), saved)
+                action = totals.setdefault(
+                    event.get('action', ''),
+                    dict.fromkeys(_ACTION_COLUMNS, 0))
+                for column, value in zip(_ACTION_COLUMNS, row):
+                    action[column] += value
+            for name, action in totals.items():
+                self._db.execute(
+                    'INSERT OR IGNORE INTO action_stats VALUES '
+                    '(?, 0, 0, 0, 0, 0, 0, 0)', (name, ))
+                self._db.execute(
+                    'UPDATE action_stats SET {} WHERE action = ?'.format(
+                        ', '.join('{0} = {0} + ?'.format(column)
+                                  for column in _ACTION_COLUMNS)),
+                    [action[column]
+                     for column in _ACTION_COLUMNS] + [name])
+        return totals
+
+    def action_stats(self):
+        """Returns [(action, {column: value})] of all recorded actions."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT action, {} FROM action_stats'.format(
+                    ', '.join(_ACTION_COLUMNS))).fetchall()
+        return [(row[0], dict(zip(_ACTION_COLUMNS, row[1:])))
+                for row in rows]
+
+    def needs_reconcile(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'reconciled'").fetchone()
+        return row is None or row[0] < time.time() - _RECONCILE_SECONDS
+
+    def reconcile(self):
+        """Rebuilds the index from a full walk of the cache directory."""
+        artifacts = []
+        refs = []
+        for root, dirs, files in os.walk(self.pycache_dir):
+            if root == self.pycache_dir:
+                if 'blobs' in dirs:
+                    dirs.remove('blobs')
+                # daemon config and index database
+                files = [f for f in files if not f.startswith('.')]
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                rel_path = os.path.relpath(path, self.pycache_dir)
+                artifacts.append((rel_path, stat.st_size, stat.st_atime))
+                for digest, size in _index_blob_sizes(path) or []:
+                    refs.append((rel_path, digest, size))
+        blobs = []
+        for root, _, files in os.walk(self.blob_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue
+                blobs.append((os.path.basename(root) + file, size))
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM artifacts')
+            self._db.execute('DELETE FROM refs')
+            self._db.execute('DELETE FROM blobs')
+            self._db.executemany('INSERT INTO artifacts VALUES (?, ?, ?)',
+                                 artifacts)
+            self._db.executemany('INSERT INTO refs VALUES (?, ?, ?)', refs)
+            self._db.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?)',
+                                 blobs)
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('reconciled', ?)",
+                (time.time(), ))
+
+    def _remove_artifacts(self, rel_paths):
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM artifacts WHERE path = ?',
+                                 [(p, ) for p in rel_paths])
+            self._db.executemany('DELETE FROM refs WHERE path = ?',
+                                 [(p, ) for p in rel_paths])
+            self._db.executemany('DELETE FROM run_times WHERE manifest = ?',
+                                 [(p, ) for p in rel_paths])
+            orphans = self._db.execute(
+                'SELECT digest FROM blobs WHERE digest NOT IN '
+                '(SELECT digest FROM refs)').fetchall()
+        for rel_path in rel_paths:
+            try:
+                os.unlink(os.path.join(self.pycache_dir, rel_path))
+            except OSError:
+                pass
+
+        young_time = time.time() - _BLOB_GRACE_SECONDS
+        removed = []
+        for (digest, ) in orphans:
+            blob = self._blob_path(digest)
+            try:
+                stat = os.stat(blob)
+                if max(stat.st_atime, stat.st_ctime) >= young_time:
+                    continue
+                os.unlink(blob)
+            except OSError:
+                pass
+            removed.append((digest, ))
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM blobs WHERE digest = ?',
+                                 removed)
+
+    def physical_bytes(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT (SELECT IFNULL(SUM(size), 0) FROM artifacts) + '
+                '(SELECT IFNULL(SUM(size), 0) FROM blobs)').fetchone()[0]
+
+    def logical_bytes(self):
+        """Artifact bytes plus the blob bytes every index refers to."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT (SELECT IFNULL(SUM(size), 0) FROM artifacts WHERE '
+                'path NOT IN (SELECT path FROM refs)) + '
+                '(SELECT IFNULL(SUM(size), 0) FROM refs)').fetchone()[0]
+
+    def evict(self, max_bytes, max_age_days):
+        """Drops artifacts unused for max_age_days, then the least
+        recently used ones until the cache fits in max_bytes."""
+        if self.needs_reconcile():
+            self.reconcile()
+        earlier_time = time.time() - max_age_days * 24 * 3600
+        with self._lock:
+            expired = [
+                row[0] for row in self._db.execute(
+                    'SELECT path FROM artifacts WHERE atime < ?',
+                    (earlier_time, ))
+            ]
+        self._remove_artifacts(expired)
+        while self.physical_bytes() > max_bytes:
+            with self._lock:
+                oldest = [
+                    row[0] for row in self._db.execute(
+                        'SELECT path FROM artifacts ORDER BY atime LIMIT ?',
+                        (_EVICT_BATCH, ))
+                ]
+            if not oldest:
+                break
+            self._remove_artifacts(oldest)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
 class PycacheDaemonRequestHandler(BaseHTTPRequestHandler):
     # Suppress logs
     def log_message(self, format, *args):  # pylint: disable=redefined-builtin
@@ -37,14 +341,6 @@ class PycacheDaemonRequestHandler(BaseHTTPRequestHandler):
         else:
             pass
 
-    def do_cache_hit(self):
-        self.server.hit_times += 1
-        self.send_response(200)
-
-    def do_cache_miss(self):
-        self.server.miss_times += 1
-        self.send_response(200)
-
     def do_cache_manage(self):
         self.send_response(200)
         self.server.cache_manage()
@@ -65,18 +361,105 @@ class PycacheDaemon(HTTPServer):
         self.stop_service = False
         self.pycache_dir = None
         self.pycache_config_file = None
+        self.cache_index = None
+        # Pycache pool holds as much as 40GB or as long as 15 days
+        # cache objects
+        self.max_bytes = 40 * 1024 * 1024 * 1024
+        self.max_age_days = 15
+        self._manage_thread = None
+        # Hit/miss events arrive on a unix datagram socket, so clients
+        # never wait for the daemon.
+        self.action_stats = {}
+        self.stats_socket = None
+        self.stats_socket_path = None
+        self._stats_lock = threading.Lock()
+        self._stats_thread = None
         super().__init__(*args, **kargs)
 
     def serve_forever(self, poll_interval=0.5):
+        self._stats_thread = threading.Thread(target=self._receive_stats)
+        self._stats_thread.start()
         while not self.stop_service:
             self.handle_request()
+        self._stats_thread.join()
+        self.drain_stats()
+        if self._manage_thread is not None:
+            self._manage_thread.join()
+        self.stats_socket.close()
+        os.unlink(self.stats_socket_path)
+        self.cache_index.close()
         os.unlink(self.pycache_config_file)
 
+    def _open_stats_socket(self):
+        path = os.path.join(self.pycache_dir, '.stats.sock')
+        if len(path.encode()) >= _MAX_SOCKET_PATH:
+            path = os.path.join(tempfile.mkdtemp(prefix='pycache_'),
+                                'stats.sock')
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        _STATS_RCVBUF)
+        self.stats_socket = sock
+        self.stats_socket_path = path
+
+    def _receive_stats(self):
+        while not self.stop_service:
+            readable, _, _ = select.select([self.stats_socket], [], [],
+                                           _STATS_POLL_SECONDS)
+            if readable:
+                self.drain_stats()
+
+    def drain_stats(self):
+        """Handles every queued event as one batch."""
+        with self._stats_lock:
+            datagrams = []
+            while True:
+                try:
+                    datagrams.append(
+                        self.stats_socket.recv(_MAX_STATS_EVENT,
+                                               socket.MSG_DONTWAIT))
+                except BlockingIOError:
+                    break
+            events = []
+            for data in datagrams:
+                try:
+                    events.append(json.loads(data.decode()))
+                except ValueError:
+                    continue
+            self._aggregate_stats(events)
+
+    def _aggregate_stats(self, events):
+        accesses = []
+        for event in events:
+            is_hit = event.get('event') == 'cache_hit'
+            if is_hit:
+                self.hit_times += 1
+            else:
+                self.miss_times += 1
+            accesses.append((event.get('artifacts', []), not is_hit))
+        if not accesses:
+            return
+        try:
+            self.cache_index.record_access(accesses)
+            totals = self.cache_index.record_telemetry(events)
+        except sqlite3.Error as err:
+            print('Warning: failed to update pycache index: {}'.format(err))
+            return
+        for name, batch in totals.items():
+            action = self.action_stats.setdefault(
+                name, dict.fromkeys(_ACTION_COLUMNS, 0))
+            for column in _ACTION_COLUMNS:
+                action[column] += batch[column]
+
     def record_pycache_config(self, pycache_dir):
         root = os.path.realpath(pycache_dir)
         self.pycache_dir = root
         self.pycache_config_file = os.path.join(root, '.config')
         os.makedirs(root, exist_ok=True)
+        self.cache_index = CacheIndex(root)
+        self._open_stats_socket()
         host, port = self.server_address[:2]
         config = {
             'root': root,
@@ -84,33 +467,27 @@ class PycacheDaemon(HTTPServer):
             'debug': bool(DEBUG),
             'host': host,
             'port': port,
+            'stats_socket': self.stats_socket_path,
         }
         with open(self.pycache_config_file, 'w') as jsonfile:
             json.dump(config, jsonfile, indent=2, sort_keys=True)
 
+    def _manage(self):
+        try:
+            self.cache_index.evict(self.max_bytes, self.max_age_days)
+        except sqlite3.Error as err:
+            print('Warning: failed to manage pycache: {}'.format(err))
+
     def cache_manage(self):
-        now = datetime.datetime.now()
-        days = 15
-        earlier_time = (now - datetime.timedelta(days)).timestamp()
-        # Pycache pool holds as much as 40GB  or as long as 15 days
-        # cache objects
-        while days > 0:
-            disk_usage = 0
-            for root, _, files in os.walk(self.pycache_dir):
-                for file in files:
-                    path = os.path.join(root, file)
-                    stat = os.stat(path)
-                    if stat.st_atime < int(earlier_time):
-                        os.unlink(path)
-                    else:
-                        disk_usage += stat.st_size
-            if disk_usage >= 40 * 1024 * 1024 * 1024:
-                days -= 1
-                earlier_time = (now - datetime.timedelta(days)).timestamp()
-            else:
-                break
+        # Runs in the background, so cache hit/miss reports keep being
+        # served while artifacts are evicted.
+        if self._manage_thread is not None and self._manage_thread.is_alive():
+            return
+        self._manage_thread = threading.Thread(target=self._manage)
+        self._manage_thread.start()
 
     def show_statistics(self):
+        self.drain_stats()
         actions = self.hit_times + self.miss_times
         if actions != 0:
             print('-' * 80)
@@ -121,14 +498,68 @@ class PycacheDaemon(HTTPServer):
             miss_rate = float(self.miss_times) / actions * 100
             print('pycache hit rate: {:.2f}%'.format(hit_rate))
             print('pycache miss rate: {:.2f}%'.format(miss_rate))
+            self.show_action_stats()
+            self.show_storage()
             print('-' * 80)
         else:
             print('-' * 80)
             print('No pycache actions in pycache, skip statistics')
             print('-' * 80)
 
+    def show_action_stats(self):
+        for name, action in sorted(self.action_stats.items()):
+            print('pycache {}: {} hits, {} misses, {:.1f} MB restored, '
+                  '{:.1f}s hashing, {:.1f}s saved'.format(
+                      name, action['hits'], action['misses'],
+                      action['bytes_restored'] / 1024.0 / 1024,
+                      action['hash_seconds'], action['saved_seconds']))
+
+    def show_storage(self):
+        logical = self.cache_index.logical_bytes()
+        physical = self.cache_index.physical_bytes()
+        ratio = float(logical) / physical if physical else 1.0
+        print('pycache storage: {:.1f} MB logical, {:.1f} MB physical, '
+              'dedup ratio {:.2f}'.format(logical / 1024.0 / 1024,
+                                          physical / 1024.0 / 1024, ratio))
+
 
-def start_server(host, port, root):
+def _print_action_rows(rows):
+    print('{:<40} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+        'action', 'hits', 'misses', 'restored', 'hashing', 'caching',
+        'saved'))
+    for name, action in rows:
+        print('{:<40} {:>7} {:>7} {:>8.1f}MB {:>8.1f}s {:>8.1f}s '
+              '{:>8.1f}s'.format(name[:40], action['hits'],
+                                 action['misses'],
+                                 action['bytes_restored'] / 1024.0 / 1024,
+                                 action['hash_seconds'],
+                                 action['cache_seconds'],
+                                 action['saved_seconds']))
+
+
+def report_actions(root, top):
+    """Ranks actions by the time pycache saved them, over all builds."""
+    if root is None or not os.path.exists(os.path.join(root, '.index.db')):
+        print('Warning: no pycache index to report on')
+        return
+    cache_index = CacheIndex(root)
+    rows = sorted(cache_index.action_stats(),
+                  key=lambda item: item[1]['saved_seconds'],
+                  reverse=True)
+    cache_index.close()
+    print('-' * 80)
+    print('pycache actions with the biggest wins:')
+    _print_action_rows(rows[:top])
+    print('pycache actions with the smallest wins:')
+    _print_action_rows(list(reversed(rows))[:top])
+    losing = [name for name, action in rows if action['saved_seconds'] < 0]
+    if losing:
+        print('pycache costs more than it saves for: {}'.format(
+            ', '.join(losing)))
+    print('-' * 80)
+
+
+def start_server(host, port, root, max_size_gb=40, max_age_days=15):
     if root is None:
         print('Warning: missing pycache root directory')
         return
@@ -136,11 +567,13 @@ def start_server(host, port, root):
     try:
         pyd = PycacheDaemon(server_address, PycacheDaemonRequestHandler)
         print('Starting pycache daemon at {}:{}'.format(host, port))
+        pyd.max_bytes = int(max_size_gb * 1024 * 1024 * 1024)
+        pyd.max_age_days = max_age_days
         pyd.record_pycache_config(root)
         pyd.serve_forever()
     except OSError as err:
         if err.errno == errno.EADDRINUSE:
-            start_server(host, port + 2, root)
+            start_server(host, port + 2, root, max_size_gb, max_age_days)
         else:
             print('Warning: Failed to start pycache daemon process')
 
@@ -203,16 +636,36 @@ def main(args):
     parser.add_argument('--manage',
                         action='store_true',
                         help='manage pycache contents')
+    parser.add_argument('--report',
+                        action='store_true',
+                        help='rank actions by the time pycache saved')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='number of actions listed per ranking')
+    parser.add_argument('--max-size-gb',
+                        type=float,
+                        default=40,
+                        help='evict least recently used cache objects '
+                        'beyond this size')
+    parser.add_argument('--max-age-days',
+                        type=float,
+                        default=15,
+                        help='evict cache objects unused for this long')
 
     options = parser.parse_args(args)
     if options.start:
-        start_server(LOCALHOST, int(options.port), options.root)
+        start_server(LOCALHOST, int(options.port), options.root,
+                     options.max_size_gb, options.max_age_days)
     if options.stop:
         stop_server()
     if options.stat:
         show_statistics()
     if options.manage:
         manage_cache_contents()
+    if options.report:
+        report_actions(options.root or os.environ.get('PYCACHE_DIR'),
+                       options.top)
 
 
 if __name__ == '__main__':
@@ -16,27 +16,18 @@
 import sys
 import argparse
 import os
-import hashlib
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 import file_utils  # noqa: E402
+import hash_utils  # noqa: E402
 from scripts.util import build_utils  # noqa: E402
 
-__MAX_BUF = 1024 * 1024
-
 
 def _gen_signature(input_file):
     if not os.path.isfile(input_file):
         raise Exception()
     hash_value = ''
-    sha256obj = hashlib.sha256()
     try:
-        with open(input_file, 'rb') as file_obj:
-            while True:
-                buf = file_obj.read(__MAX_BUF)
-                if not buf:
-                    break
-                sha256obj.update(buf)
-            hash_value = sha256obj.hexdigest()
+        hash_value = hash_utils.file_digest(input_file, 'sha256')
     except OSError as err:
         sys.stdout.write("read file failed. {}".format(err))
     return hash_value